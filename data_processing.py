@@ -1,6 +1,5 @@
 import collections
 import itertools
-import multiprocessing
 import subprocess
 from time import sleep
 from typing import Any, Callable, Iterable, Set, Tuple, Union, List, Dict
@@ -17,6 +16,7 @@ def pipeline(functions: Iterable[Callable], initial_data: Any, parallel: bool=Tr
     """
     data = initial_data
     if parallel:
+        import multiprocessing  # only pay for this in scripts that actually use a pool
         with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
             for f in functions:
                 data = pool.map(f, data)
@@ -27,6 +27,7 @@ def pipeline(functions: Iterable[Callable], initial_data: Any, parallel: bool=Tr
 
 
 def parallel_map(function: Callable, data: Iterable[Any]) -> Iterable[Any]:
+    import multiprocessing
     with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
         return pool.map(function, data)
 
@@ -36,6 +37,11 @@ def synchronous_map(fn: Callable, data: Iterable[Any]):
 
 
 def synchronous_subprocess(*args: Any, **kwargs: Any) -> subprocess.CompletedProcess:
+    """
+    Beyond the usual cwd & check, kwargs may include input (bytes to send to stdin), stdout (a file to stream stdout into),
+    capture_stdout/capture_stderr=False to let the output go to the console, or text=False to get stdout as raw bytes
+    (stderr is always decoded).
+    """
     if len(args) == 1:
         if isinstance(args[0], list):
             args = args[0]
@@ -44,17 +50,20 @@ def synchronous_subprocess(*args: Any, **kwargs: Any) -> subprocess.CompletedPro
 
     try:
         out = subprocess.run([str(arg) for arg in args],
-                             stdout=None if 'capture_stdout' in kwargs and not kwargs['capture_stdout'] else subprocess.PIPE,
+                             input=kwargs['input'] if 'input' in kwargs else None,
+                             stdout=kwargs['stdout'] if 'stdout' in kwargs else None if 'capture_stdout' in kwargs and not kwargs['capture_stdout'] else subprocess.PIPE,
                              stderr=None if 'capture_stderr' in kwargs and not kwargs['capture_stderr'] else subprocess.PIPE,
                              cwd=str(kwargs['cwd']) if 'cwd' in kwargs else None,
                              check=kwargs['check'] if 'check' in kwargs else None)
     except subprocess.CalledProcessError as e:
         e.stderr = e.stderr.decode(errors='replace') if e.stderr else ''
-        e.stdout = e.stdout.decode(errors='replace') if e.stdout else ''
+        if kwargs.get('text', True):
+            e.stdout = e.stdout.decode(errors='replace') if e.stdout else ''
         raise e
-    else:  # Let's not make clients down the line deal with bytes objects
+    else:  # Let's not make clients down the line deal with bytes objects (unless they asked for them)
         out.stderr = out.stderr.decode(errors='replace') if out.stderr else ''
-        out.stdout = out.stdout.decode(errors='replace') if out.stdout else ''
+        if kwargs.get('text', True):
+            out.stdout = out.stdout.decode(errors='replace') if out.stdout else ''
     return out
 
 
@@ -1,13 +1,19 @@
+import functools
+import json
+import logging
 import math
+import os
 import re
 import shutil
 import subprocess
-from contextlib import suppress
+import tempfile
+import traceback
+from collections import namedtuple
 from pathlib import Path
-from typing import FrozenSet, Tuple, Union, List, Iterable
+from typing import FrozenSet, Tuple, Union, List, Iterable, Iterator, Callable, Dict, Optional
 
-from utils.data_processing import checked_subprocess
-from utils.files import Pathlike, read_binary, sanitize_file_name, write_file, file_sizes
+from utils.data_processing import checked_subprocess, reified_partition
+from utils.files import Pathlike, read_binary, read_lines, write_file, file_sizes
 
 
 class LatLon(tuple):
@@ -17,6 +23,8 @@ class LatLon(tuple):
 
     def __str__(self): return '%+03d%+04d' % (self[0], self[1])
 
+    def __getnewargs__(self): return self[0], self[1]  # lets us pickle tiles over to worker processes
+
     @property
     def folder_and_file_stem(self) -> str:
         return '%+03d%+04d/%s' % (self[0] - self[0] % 10, self[1] - self[1] % 10, self)
@@ -87,10 +95,8 @@ def all_tiles(degree_width_height: int=1, min_lat=-60, max_lat=74) -> FrozenSet[
                      for lat in range(min_lat, max_lat, degree_width_height))
 
 def tiles_on_disk(dsf_structured_directory: Path, file_suffix: str='.dsf') -> FrozenSet[LatLon]:
-    assert dsf_structured_directory.is_dir(), f'No such directory {dsf_structured_directory}'
-    return frozenset(LatLon.from_str(f.stem)
-                     for f in dsf_structured_directory.glob('*/*')
-                     if is_dsf_like_path(f) and f.suffix == file_suffix and f.is_file())
+    """If you need more than one suffix, or will be asking repeatedly, keep a TileInventory around instead"""
+    return TileInventory(dsf_structured_directory).tiles(file_suffix)
 
 def dsf_tile_bbox(file_name: Union[LatLon, Path], width_height_deg=1) -> Tuple[int, int, int, int]:
     base_lat_lon = file_name if isinstance(file_name, LatLon) else LatLon.from_str(file_name.stem)
@@ -112,69 +118,380 @@ def tiles_in_10x10(folder_lat_lon: Union[str, Path, LatLon]) -> FrozenSet[LatLon
                      for lat in range(folder_lat_lon.lat, folder_lat_lon.lat + 10))
 
 
+_world_cols = 360
+_world_rows = 180
+_popcount = getattr(int, 'bit_count', lambda bits: bin(bits).count('1'))
+
+def _span_bits(first_col: int, end_col: int) -> int:
+    """A row's worth of bits with columns [first_col, end_col) set"""
+    return ((1 << (end_col - first_col)) - 1) << first_col
+
+def _repeated_rows(row_bits: int, first_row: int, end_row: int) -> int:
+    out = 0
+    for row in range(first_row, end_row):
+        out |= row_bits << (row * _world_cols)
+    return out
+
+_folder_masks = [_repeated_rows(_span_bits(col, col + 10), 0, 10) for col in range(0, _world_cols, 10)]  # within a 10-row band
+
+
+class TileSet:
+    """
+    A set of 1x1 degree tiles, stored as a bitmap of the 180x360 world grid (in one Python int),
+    so union/intersection/difference are a single big-int operation rather than churning through tens of
+    thousands of LatLon objects. Iterating gives you LatLons, and to_frozenset() gets you back the classic type.
+
+    >>> a = TileSet.from_bbox(-123, 47, -121, 49)
+    >>> [str(tile) for tile in a]
+    ['+47-123', '+47-122', '+48-123', '+48-122']
+    >>> b = TileSet([LatLon(48, -122), LatLon(10, 10)])
+    >>> len(a | b), len(a & b), len(a - b), LatLon(10, 10) in b
+    (5, 1, 3, True)
+    >>> (a & b).to_frozenset() == frozenset({LatLon(48, -122)})
+    True
+    >>> len(TileSet.all_tiles()) == len(all_tiles())
+    True
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, tiles: Iterable[LatLon]=()):
+        bits = 0
+        for tile in tiles:
+            bits |= 1 << self._bit(tile)
+        self.bits = bits
+
+    @staticmethod
+    def _bit(tile: LatLon) -> int:
+        assert -90 <= tile.lat < 90 and -180 <= tile.lon < 180, f'Tile {tile} is outside the world'
+        return (tile.lat + 90) * _world_cols + tile.lon + 180
+
+    @classmethod
+    def from_bits(cls, bits: int) -> 'TileSet':
+        out = cls()
+        out.bits = bits
+        return out
+
+    @classmethod
+    def from_bbox(cls, west: float, south: float, east: float, north: float) -> 'TileSet':
+        """All tiles overlapping the bounds, in the same (west, south, east, north) order as dsf_tile_bbox()"""
+        first_col, end_col = max(math.floor(west), -180) + 180, min(math.ceil(east), 180) + 180
+        first_row, end_row = max(math.floor(south), -90) + 90, min(math.ceil(north), 90) + 90
+        if first_col >= end_col or first_row >= end_row:
+            return cls()
+        return cls.from_bits(_repeated_rows(_span_bits(first_col, end_col), first_row, end_row))
+
+    @classmethod
+    def all_tiles(cls, min_lat=-60, max_lat=74) -> 'TileSet':
+        return cls.from_bbox(-180, min_lat, 180, max_lat)
+
+    @classmethod
+    def tiles_in_10x10(cls, folder_lat_lon: Union[str, Path, LatLon]) -> 'TileSet':
+        if not isinstance(folder_lat_lon, LatLon):
+            folder_lat_lon = LatLon.from_str(Path(folder_lat_lon).name)
+        return cls.from_bbox(folder_lat_lon.lon, folder_lat_lon.lat, folder_lat_lon.lon + 10, folder_lat_lon.lat + 10)
+
+    def to_frozenset(self) -> FrozenSet[LatLon]:
+        return frozenset(self)
+
+    def counts_per_10x10(self) -> Dict[LatLon, int]:
+        """Maps each 10x10 folder that has any tiles in this set to the number of tiles it has"""
+        out = {}
+        band_mask = (1 << (10 * _world_cols)) - 1
+        for band in range(_world_rows // 10):
+            band_bits = (self.bits >> (band * 10 * _world_cols)) & band_mask
+            if band_bits:
+                for col, folder_mask in enumerate(_folder_masks):
+                    count = _popcount(band_bits & folder_mask)
+                    if count:
+                        out[LatLon(lat=band * 10 - 90, lon=col * 10 - 180)] = count
+        return out
+
+    def __iter__(self) -> Iterator[LatLon]:
+        row_mask = (1 << _world_cols) - 1
+        for row in range(_world_rows):
+            row_bits = (self.bits >> (row * _world_cols)) & row_mask
+            while row_bits:
+                lowest = row_bits & -row_bits
+                yield LatLon(lat=row - 90, lon=lowest.bit_length() - 1 - 180)
+                row_bits ^= lowest
+
+    def __contains__(self, tile: LatLon) -> bool: return bool(self.bits >> self._bit(tile) & 1)
+    def __len__(self) -> int: return _popcount(self.bits)
+    def __bool__(self) -> bool: return bool(self.bits)
+    def __eq__(self, other) -> bool: return isinstance(other, TileSet) and self.bits == other.bits
+    def __hash__(self) -> int: return hash(self.bits)
+    def __or__(self, other: 'TileSet') -> 'TileSet': return TileSet.from_bits(self.bits | other.bits)
+    def __and__(self, other: 'TileSet') -> 'TileSet': return TileSet.from_bits(self.bits & other.bits)
+    def __sub__(self, other: 'TileSet') -> 'TileSet': return TileSet.from_bits(self.bits & ~other.bits)
+    def __xor__(self, other: 'TileSet') -> 'TileSet': return TileSet.from_bits(self.bits ^ other.bits)
+    def __repr__(self): return f'TileSet({len(self)} tiles)'
+
+
+TileFile = namedtuple('TileFile', ['size', 'mtime_ns'])
+
+class TileInventory:
+    """
+    Which DSF-named files (+47-123.dsf, +47-123.pvr, etc.) exist for each tile in a DSF-structured directory,
+    with their sizes & mtimes, all from a single scandir() pass over the tree.
+
+    Keep one around and refresh() will only rescan the 10x10 folders whose mtime changed; pass a cache_path to
+    carry that across runs too. Note that rewriting a file in place doesn't change its folder's mtime, so the
+    size & mtime we report for such a file may be stale (though we'll never miss one being added or removed).
+    """
+    def __init__(self, dsf_structured_directory: Path, cache_path: Optional[Path]=None):
+        assert dsf_structured_directory.is_dir(), f'No such directory {dsf_structured_directory}'
+        self.root = dsf_structured_directory
+        self.cache_path = cache_path
+        self._folders: Dict[str, Tuple[int, Dict[LatLon, Dict[str, TileFile]]]] = {}  # folder name -> (folder mtime, its tiles)
+        if cache_path and cache_path.is_file():
+            cached = json.loads(cache_path.read_text())
+            if cached['root'] == str(self.root.resolve()):
+                self._folders = {folder: (mtime_ns, {LatLon.from_str(tile): {suffix: TileFile(*file) for suffix, file in files.items()}
+                                                     for tile, files in tiles.items()})
+                                 for folder, (mtime_ns, tiles) in cached['folders'].items()}
+        self.files: Dict[LatLon, Dict[str, TileFile]] = {}  # maps tiles to the files for each suffix
+        self.refresh()
+
+    def refresh(self):
+        folders = {}
+        with os.scandir(self.root) as entries:
+            for folder in entries:
+                if folder.is_dir():
+                    mtime_ns = folder.stat().st_mtime_ns
+                    cached = self._folders.get(folder.name)
+                    folders[folder.name] = cached if cached and cached[0] == mtime_ns else (mtime_ns, self._scan_folder(folder.path))
+        self._folders = folders
+
+        self.files = {}
+        for _mtime_ns, tiles in self._folders.values():
+            for tile, files in tiles.items():
+                self.files.setdefault(tile, {}).update(files)
+
+        if self.cache_path:
+            self.cache_path.write_text(json.dumps({
+                'root': str(self.root.resolve()),
+                'folders': {folder: [mtime_ns, {str(tile): files for tile, files in tiles.items()}]
+                            for folder, (mtime_ns, tiles) in self._folders.items()}
+            }))
+
+    @staticmethod
+    def _scan_folder(folder_path: str) -> Dict[LatLon, Dict[str, TileFile]]:
+        out = {}
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                stem, suffix = os.path.splitext(entry.name)
+                if dsf_re.match(stem) and entry.is_file():
+                    stat = entry.stat()
+                    out.setdefault(LatLon.from_str(stem), {})[suffix] = TileFile(stat.st_size, stat.st_mtime_ns)
+        return out
+
+    def tiles(self, file_suffix: str='.dsf') -> FrozenSet[LatLon]:
+        return frozenset(tile for tile, files in self.files.items() if file_suffix in files)
+
+    def tile_set(self, file_suffix: str='.dsf') -> TileSet:
+        return TileSet(tile for tile, files in self.files.items() if file_suffix in files)
+
+    def suffixes(self, tile: LatLon) -> Dict[str, TileFile]:
+        return self.files.get(tile, {})
+
+
 def dsf_is_7zipped(dsf_path: Path) -> bool:
     with dsf_path.open('rb') as dsf:
         return dsf.read(2) == b'7z'
 
 def unzip_dsf(zipped_dsf_path: Path, unzipped_out_path: Path):
-    out_dir = sanitize_file_name(zipped_dsf_path.name)
-    # Irritatingly, 7za doesn't let us just specify the final output path for a single file... only the name of the directory we'll unzip "everything" into
-    checked_subprocess('7za', 'e', zipped_dsf_path, f'-o{out_dir}')
-    unzipped_dsf = Path(out_dir) / zipped_dsf_path.name
-    unzipped_dsf.replace(unzipped_out_path)  # Move the newly unzipped file to the target path
-    shutil.rmtree(out_dir)  # Clean up temp unzip directory
+    # Have 7za stream the file to stdout, since it doesn't let us specify the final output path for a single file
+    # (only the name of a directory to unzip "everything" into)
+    with unzipped_out_path.open('wb') as out_file:
+        checked_subprocess('7za', 'e', '-so', zipped_dsf_path, stdout=out_file)
     return unzipped_out_path
 
 def zip_dsf(unzipped_dsf: Path, zipped_out_path: Path):
-    tmp_7z_file = zipped_out_path.with_suffix('.7z')
-    checked_subprocess('7za', 'a', '-m0=LZMA', tmp_7z_file, unzipped_dsf)
-    zipped_out_path.unlink()
-    tmp_7z_file.rename(zipped_out_path)
+    # Build the archive in a private temp dir beside the target, so that concurrent jobs can't collide and the final move is atomic
+    with tempfile.TemporaryDirectory(dir=zipped_out_path.parent) as tmp_dir:
+        tmp_7z_file = Path(tmp_dir) / zipped_out_path.with_suffix('.7z').name
+        checked_subprocess('7za', 'a', '-m0=LZMA', tmp_7z_file, unzipped_dsf)
+        tmp_7z_file.replace(zipped_out_path)
+
+def read_dsf_bytes(dsf_path: Path) -> bytes:
+    """The raw (unzipped) binary DSF, decompressed in memory if need be"""
+    if dsf_is_7zipped(dsf_path):
+        return checked_subprocess('7za', 'e', '-so', dsf_path, text=False).stdout or b''
+    return read_binary(dsf_path)
+
 
+_end_of_dsf_txt = '# Result code: '
 
 def dsf_to_txt(source_dsf_path: Path, dsf_tool: Path) -> str:
     """
     Converts the (binary) DSF to text form (in memory, rather than on disk, for easy manipulation).
-    Leaves no temp files around on disk.
+    Zipped DSFs get unzipped into a private temp directory, so this is safe to run in parallel.
+    """
+    return ''.join(iter_dsf_txt(source_dsf_path, dsf_tool))
+
+
+def iter_dsf_txt(source_dsf_path: Path, dsf_tool: Path) -> Iterator[str]:
+    """
+    Like dsf_to_txt(), but yields the DSF text one line at a time (line endings included) as DSFTool produces it,
+    so you never need to hold the whole tile's text in memory. Pair it with txt_to_dsf() (which streams an iterable
+    of lines out to DSFTool) for transforms that run in constant memory:
+        txt_to_dsf((line for line in iter_dsf_txt(src, dsf_tool) if keep(line)), dst, dsf_tool)
     """
     assert source_dsf_path.suffix == '.dsf'
     if not source_dsf_path.is_file():
         raise FileNotFoundError('Could not find source DSF %s' % source_dsf_path)
 
-    is_zipped = dsf_is_7zipped(source_dsf_path)
-    if is_zipped:
-        dsf_to_read = source_dsf_path.with_suffix('.unzipped')
-        unzip_dsf(source_dsf_path, dsf_to_read)
-    else:
-        dsf_to_read = source_dsf_path
-
-    result = checked_subprocess(dsf_tool, '-dsf2text', dsf_to_read, '-')
-    if 'ERROR:' in result.stderr:
-        raise RuntimeError(f'Error converting DSF:\n{result.stderr}')
-    end_of_output = '# Result code: '
-
-    if is_zipped:
-        dsf_to_read.unlink()
-    return result.stdout.split(end_of_output)[0]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if dsf_is_7zipped(source_dsf_path):
+            dsf_to_read = unzip_dsf(source_dsf_path, Path(tmp_dir) / source_dsf_path.name)
+        else:
+            dsf_to_read = source_dsf_path
+
+        # Send stderr to a file rather than a pipe: nobody would be reading the pipe while we stream stdout
+        with (Path(tmp_dir) / 'stderr.txt').open('w+') as stderr:
+            process = subprocess.Popen([str(dsf_tool), '-dsf2text', str(dsf_to_read), '-'],
+                                       stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True, errors='replace')
+            try:
+                for line in process.stdout:
+                    if line.startswith(_end_of_dsf_txt):
+                        break
+                    yield line
+                process.stdout.close()
+                return_code = process.wait()
+            finally:
+                if process.poll() is None:  # our consumer stopped early
+                    process.kill()
+                    process.wait()
+            stderr.seek(0)
+            errors = stderr.read()
+    if return_code or 'ERROR:' in errors:
+        raise RuntimeError(f'Error converting DSF:\n{errors}')
 
 
 def txt_to_dsf(dsf_txt_lines: Union[str, Iterable[str]], target_dsf_path: Path, dsf_tool: Path, compress: bool=True) -> subprocess.CompletedProcess:
-    """Writes your DSF text lines to a binary DSF file"""
+    """
+    Writes your DSF text lines to a binary DSF file.
+    An iterable of lines (e.g., a generator over iter_dsf_txt()) is streamed to disk as it's consumed, never held in memory.
+    Intermediate files live in a private temp directory beside the target, so this is safe to run in parallel,
+    and the target is replaced atomically.
+    """
     assert target_dsf_path.suffix == '.dsf'
+    target_dsf_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=target_dsf_path.parent) as tmp_dir:
+        tmp_txt_path = Path(tmp_dir) / target_dsf_path.with_suffix('.txt').name
+        tmp_dsf_path = Path(tmp_dir) / target_dsf_path.name
+        write_file(dsf_txt_lines, tmp_txt_path)
+        result = checked_subprocess(dsf_tool, '-text2dsf', tmp_txt_path, tmp_dsf_path)
+        if compress:
+            zip_dsf(tmp_dsf_path, target_dsf_path)
+        else:
+            tmp_dsf_path.replace(target_dsf_path)
+    return result
 
-    tmp_txt_path: Path = target_dsf_path.with_suffix('.txt')
-    write_file(dsf_txt_lines, tmp_txt_path)
 
-    target_dsf_path.parent.mkdir(parents=True, exist_ok=True)
-    result = checked_subprocess(dsf_tool, '-text2dsf', tmp_txt_path, target_dsf_path)
-    tmp_txt_path.unlink()
+TileResult = namedtuple('TileResult', ['tile', 'status', 'error'])  # status is 'processed', 'skipped' or 'failed' (in which case error has the traceback)
+DsfTransform = Callable[[str], Union[str, Iterable[str]]]  # takes a tile's DSF text, returns the new text (or lines)
 
-    if compress:
-        zip_dsf(target_dsf_path, target_dsf_path)
-    return result
+def _transform_dsf_tile(tile: LatLon, source_dir: Path, dest_dir: Path, transform: DsfTransform, dsf_tool: Path, compress: bool) -> TileResult:
+    try:
+        dsf_txt = dsf_to_txt(source_dir / f'{tile.folder_and_file_stem}.dsf', dsf_tool)
+        txt_to_dsf(transform(dsf_txt), dest_dir / f'{tile.folder_and_file_stem}.dsf', dsf_tool, compress)
+        return TileResult(tile, 'processed', None)
+    except Exception:
+        return TileResult(tile, 'failed', traceback.format_exc())
 
+def _transform_key(transform: DsfTransform) -> str:
+    """
+    Identifies the transform across runs by name (and, for partials, arguments)
 
-with suppress(ModuleNotFoundError):
+    >>> import functools
+    >>> _transform_key(functools.partial(math.copysign, 2))
+    'math.copysign(*(2,), **{})'
+    >>> _transform_key(functools.partial(math.copysign, 2)) == _transform_key(functools.partial(math.copysign, 3))
+    False
+    >>> class Scale:
+    ...     def __call__(self, dsf_txt): return dsf_txt
+    >>> _transform_key(Scale())
+    'utils.dsf.Scale'
+    >>> _transform_key(functools.partial(math.copysign, object()))
+    Traceback (most recent call last):
+    ...
+    AssertionError: Can't tell whether math.copysign's arguments changed between runs (they print as memory addresses); pass transform_key
+    """
+    if isinstance(transform, functools.partial):
+        name = _transform_key(transform.func)
+        arguments = f'(*{transform.args!r}, **{transform.keywords!r})'
+        assert not _memory_address_re.search(arguments), \
+            f"Can't tell whether {name}'s arguments changed between runs (they print as memory addresses); pass transform_key"
+        return name + arguments
+    if not hasattr(transform, '__qualname__'):  # a callable object rather than a function
+        transform = type(transform)
+    return f'{transform.__module__}.{transform.__qualname__}'
+
+_memory_address_re = re.compile(r' at 0x[0-9a-fA-F]+')
+
+def transform_dsfs(source_dir: Path, dest_dir: Path, transform: DsfTransform, dsf_tool: Path,
+                   tiles: Optional[Iterable[LatLon]]=None,
+                   progress_file: Optional[Path]=None,
+                   transform_key: Optional[str]=None,
+                   max_processes: int=os.cpu_count(),
+                   compress: bool=True) -> List[TileResult]:
+    """
+    Runs dsf_to_txt() -> transform -> txt_to_dsf() over every tile, with up to max_processes tiles
+    (and thus DSFTool/7za processes) in flight at once. A tile that fails doesn't take the others down with it.
+
+    @param transform Gets shipped off to worker processes, so it must be picklable (i.e., a module-level function or a functools.partial of one)
+    @param tiles The tiles to process; defaults to all those in source_dir
+    @param progress_file Records the size & mtime of each source DSF as it's successfully processed. Tiles whose source
+                         is unchanged since (and whose output still exists) are skipped, so you can resume an interrupted
+                         run, or re-run over a set where only a few tiles changed.
+    @param transform_key Recorded in the progress file alongside each tile; tiles processed under a different key are
+                         never skipped. Defaults to the transform's name (plus its arguments, for a partial; or its class,
+                         for a callable object), so bump this (e.g., 'my_transform v2') whenever you change what the
+                         transform does. Required if the partial's arguments print as memory addresses.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed  # pulls in multiprocessing, which most users of this module never need
+
+    tiles = sorted(tiles if tiles is not None else tiles_on_disk(source_dir))
+    transform_key = transform_key or _transform_key(transform)
+
+    done: Dict[str, list] = {}  # tile -> [source size, source mtime, transform key]
+    if progress_file and progress_file.is_file():
+        for line in read_lines(progress_file):
+            done.update(json.loads(line))
+
+    def progress_record(tile: LatLon) -> list:
+        stat = (source_dir / f'{tile.folder_and_file_stem}.dsf').stat()
+        return [stat.st_size, stat.st_mtime_ns, transform_key]
+
+    def is_unchanged(tile: LatLon) -> bool:
+        return str(tile) in done and \
+               (dest_dir / f'{tile.folder_and_file_stem}.dsf').is_file() and \
+               done[str(tile)] == progress_record(tile)
+
+    to_process, to_skip = reified_partition(is_unchanged, tiles)
+    results = [TileResult(tile, 'skipped', None) for tile in to_skip]
+    progress = progress_file.open('a') if progress_file else None
+    try:
+        with ProcessPoolExecutor(max_processes) as pool:
+            pending = [pool.submit(_transform_dsf_tile, tile, source_dir, dest_dir, transform, dsf_tool, compress) for tile in to_process]
+            for future in as_completed(pending):
+                result = future.result()
+                results.append(result)
+                if result.status == 'failed':
+                    logging.error(f'Failed to process {result.tile}:\n{result.error}')
+                elif progress:
+                    progress.write(json.dumps({str(result.tile): progress_record(result.tile)}) + '\n')
+                    progress.flush()
+    finally:
+        if progress:
+            progress.close()
+    logging.info(f'Processed {len(to_process)} tiles ({sum(r.status == "failed" for r in results)} failed); skipped {len(to_skip)} unchanged')
+    return results
+
+
+def _shapefile_class() -> type:
+    """Importing pyshp is deferred until somebody first asks for dsf.Shapefile (see __getattr__ below)"""
     import shapefile  # from pyshp
 
     class Shapefile(shapefile.Reader):
@@ -227,3 +544,15 @@ with suppress(ModuleNotFoundError):
             """:return size in bytes of the sum of .shp, .shx, and .dbf file"""
             return file_sizes(Shapefile.all_extensions(shp_path))
 
+    Shapefile.__module__, Shapefile.__qualname__ = __name__, 'Shapefile'  # so it pickles as dsf.Shapefile
+    return Shapefile
+
+
+def __getattr__(name: str):
+    if name == 'Shapefile':
+        try:
+            globals()['Shapefile'] = _shapefile_class()
+        except ModuleNotFoundError as e:  # so that hasattr(dsf, 'Shapefile') is False, as it was before we deferred the import
+            raise AttributeError(f'module {__name__!r} has no attribute {name!r} (it requires pyshp)') from e
+        return globals()['Shapefile']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+A native reader for binary DSF files, for when you only need to inspect a tile and don't want to pay for
+expanding it to text through DSFTool. See the DSF spec: https://developer.x-plane.com/article/dsf-file-format-specification/
+
+We read the atom tree in place through memoryviews (of an mmap, for unzipped DSFs), so looking at the header
+properties, bounds and definitions never touches the (much larger) geometry or command atoms.
+"""
+import hashlib
+import mmap
+import struct
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from utils.dsf import dsf_is_7zipped, read_dsf_bytes
+
+DsfAtom = namedtuple('DsfAtom', ['id', 'data'])  # data is a memoryview of the atom's payload (excluding its 8 byte header)
+RasterInfo = namedtuple('RasterInfo', ['name', 'version', 'bytes_per_pixel', 'flags', 'width', 'height', 'scale', 'offset'])
+
+_cookie = b'XPLNEDSF'
+_header = struct.Struct('<8si')
+_atom_header = struct.Struct('<ii')
+_demi = struct.Struct('<BBHIIff')
+_md5_footer_size = 16
+
+_raster_float, _raster_signed = 0, 1  # otherwise, unsigned
+
+
+def _atom_id(raw_id: int) -> str:
+    """Atom IDs are multi-character constants stored as little-endian ints, so 'HEAD' is on disk as 'DAEH'"""
+    return struct.pack('>i', raw_id).decode('ascii')
+
+
+def _atoms(data: memoryview) -> List[DsfAtom]:
+    """Reads just the headers of the atoms at this level of the tree"""
+    atoms = []
+    pos = 0
+    while pos + _atom_header.size <= len(data):
+        raw_id, size = _atom_header.unpack_from(data, pos)
+        assert size >= _atom_header.size and pos + size <= len(data), f'Corrupt DSF atom at offset {pos}'
+        atoms.append(DsfAtom(_atom_id(raw_id), data[pos + _atom_header.size:pos + size]))
+        pos += size
+    return atoms
+
+
+def _string_table(data: memoryview) -> List[str]:
+    return [s.decode('utf-8') for s in bytes(data).split(b'\0')[:-1]]
+
+
+def _decode_planar_numeric(data: memoryview, item_type: str, scales: memoryview):
+    """
+    Decodes a POOL or PO32 atom and its SCAL/SC32 into an array of shape (points, planes).
+    Each plane may be raw, differenced, run-length encoded, or both.
+
+    >>> pool = (struct.pack('<iB', 4, 2) +  # 4 points of 2 planes
+    ...         bytes([3, 0x81]) + struct.pack('<H', 1000) + bytes([0x83]) + struct.pack('<H', 10) +  # differenced & RLE: 1000, then +10 three times
+    ...         bytes([2, 0x04]) + struct.pack('<4H', 1, 2, 3, 4))  # RLE of 4 literal values
+    >>> scales = struct.pack('<4f', 65535 / 4, 10, 0, 5)  # (scale, offset) per plane; a 0 scale means the values are used as-is
+    >>> _decode_planar_numeric(memoryview(pool), '<u2', memoryview(scales)).tolist()
+    [[260.0, 6.0], [262.5, 7.0], [265.0, 8.0], [267.5, 9.0]]
+    """
+    import numpy as np  # only needed for geometry, not for inspecting the header & definitions
+
+    dtype = np.dtype(item_type)
+    item_max = float(np.iinfo(dtype).max)
+    num_points, num_planes = struct.unpack_from('<iB', data, 0)
+    out = np.empty((num_points, num_planes), dtype=np.float64)
+    plane_scales = np.frombuffer(scales, dtype='<f4').reshape(-1, 2)
+    assert len(plane_scales) == num_planes, 'Scaling atom does not match its point pool'
+
+    pos = 5
+    for plane in range(num_planes):
+        encoding = data[pos]
+        pos += 1
+        if encoding & 2:  # run-length encoded
+            runs = []
+            decoded = 0
+            while decoded < num_points:
+                code = data[pos]
+                pos += 1
+                count = code & 0x7F
+                if code & 0x80:  # one value, repeated
+                    runs.append(np.repeat(np.frombuffer(data, dtype=dtype, count=1, offset=pos), count))
+                    pos += dtype.itemsize
+                else:  # count literal values
+                    runs.append(np.frombuffer(data, dtype=dtype, count=count, offset=pos))
+                    pos += count * dtype.itemsize
+                decoded += count
+            values = np.concatenate(runs) if runs else np.empty(0, dtype=dtype)
+        else:
+            values = np.frombuffer(data, dtype=dtype, count=num_points, offset=pos)
+            pos += num_points * dtype.itemsize
+
+        if encoding & 1:  # differenced: each value is relative to the one before, with wrap-around
+            values = np.cumsum(values, dtype=dtype)
+
+        scale, offset = plane_scales[plane]
+        out[:, plane] = values * (scale / item_max) + offset if scale else values + offset
+    return out
+
+
+class DsfFile:
+    """A binary DSF, e.g. DsfFile.open(Path('Earth nav data/+40-130/+47-123.dsf')).bounds"""
+    def __init__(self, dsf_data: Union[bytes, mmap.mmap]):
+        self.data = memoryview(dsf_data)
+        cookie, version = _header.unpack_from(self.data, 0)
+        if cookie != _cookie:
+            raise ValueError('Not a DSF file (did you forget to unzip it?)')
+        assert version == 1, f'Unsupported DSF version {version}'
+        self.atoms: Dict[str, DsfAtom] = {atom.id: atom for atom in _atoms(self.data[_header.size:-_md5_footer_size])}
+
+    @staticmethod
+    def open(dsf_path: Path) -> 'DsfFile':
+        """7-zipped DSFs are decompressed in memory; unzipped DSFs are mapped, not read"""
+        if dsf_is_7zipped(dsf_path):
+            return DsfFile(read_dsf_bytes(dsf_path))
+        with dsf_path.open('rb') as f:
+            return DsfFile(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def checksum_is_valid(self) -> bool:
+        return hashlib.md5(self.data[:-_md5_footer_size]).digest() == bytes(self.data[-_md5_footer_size:])
+
+    def child_atoms(self, parent_id: str) -> List[DsfAtom]:
+        return _atoms(self.atoms[parent_id].data) if parent_id in self.atoms else []
+
+    def _child_strings(self, parent_id: str, child_id: str) -> List[str]:
+        return [s
+                for atom in self.child_atoms(parent_id) if atom.id == child_id
+                for s in _string_table(atom.data)]
+
+    @property
+    def properties(self) -> List[Tuple[str, str]]:
+        """The header's (name, value) pairs, in order. A name may repeat (e.g., sim/require_object)."""
+        strings = self._child_strings('HEAD', 'PROP')
+        return list(zip(strings[0::2], strings[1::2]))
+
+    def property_value(self, name: str) -> Optional[str]:
+        return next((value for prop_name, value in self.properties if prop_name == name), None)
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """(west, south, east, north), same order as dsf_tile_bbox()"""
+        props = dict(self.properties)
+        return float(props['sim/west']), float(props['sim/south']), float(props['sim/east']), float(props['sim/north'])
+
+    @property
+    def terrain_defs(self) -> List[str]: return self._child_strings('DEFN', 'TERT')
+
+    @property
+    def object_defs(self) -> List[str]: return self._child_strings('DEFN', 'OBJT')
+
+    @property
+    def polygon_defs(self) -> List[str]: return self._child_strings('DEFN', 'POLY')
+
+    @property
+    def network_defs(self) -> List[str]: return self._child_strings('DEFN', 'NETW')
+
+    @property
+    def raster_names(self) -> List[str]: return self._child_strings('DEFN', 'DEMN')
+
+    @property
+    def rasters(self) -> List[RasterInfo]:
+        infos = [atom for atom in self.child_atoms('DEMS') if atom.id == 'DEMI']
+        return [RasterInfo(name, *_demi.unpack_from(info.data, 0))
+                for name, info in zip(self.raster_names, infos)]
+
+    def raster_data(self, raster_idx: int):
+        """The raster's scaled values as a (height, width) NumPy array"""
+        import numpy as np
+
+        info = self.rasters[raster_idx]
+        data = [atom for atom in self.child_atoms('DEMS') if atom.id == 'DEMD'][raster_idx].data
+        kind = info.flags & 3
+        if kind == _raster_float:
+            dtype = {4: '<f4', 8: '<f8'}[info.bytes_per_pixel]
+        else:
+            dtype = f'<{"i" if kind == _raster_signed else "u"}{info.bytes_per_pixel}'
+        raw = np.frombuffer(data, dtype=dtype, count=info.width * info.height).reshape(info.height, info.width)
+        return raw * info.scale + info.offset
+
+    def point_pools(self) -> List:
+        """The 16-bit point pools (POOL atoms), each decoded into a (points, planes) NumPy array"""
+        return self._point_pools('POOL', 'SCAL', '<u2')
+
+    def point_pools_32(self) -> List:
+        """The 32-bit point pools (PO32 atoms), each decoded into a (points, planes) NumPy array"""
+        return self._point_pools('PO32', 'SC32', '<u4')
+
+    def _point_pools(self, pool_id: str, scale_id: str, item_type: str) -> List:
+        geod = self.child_atoms('GEOD')
+        pools = [atom.data for atom in geod if atom.id == pool_id]
+        scales = [atom.data for atom in geod if atom.id == scale_id]
+        assert len(pools) == len(scales), f'Each {pool_id} atom needs a matching {scale_id}'
+        return [_decode_planar_numeric(pool, item_type, scale) for pool, scale in zip(pools, scales)]
@@ -2,9 +2,9 @@ import hashlib
 import os
 import platform
 import string
-import urllib.request
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Union, Iterable, List, Callable, Optional
+from typing import Union, Iterable, Iterator, List, Callable, Optional, BinaryIO
 
 Pathlike = Union[Path, str]
 MaybePathlike = Union[Pathlike, None]
@@ -62,12 +62,27 @@ def sanitize_file_name(file_name: str, replace_sanitized_chars_with: str='') ->
 def read_from_web_or_disk(url_or_path: Union[Path, str]):
     path = str(url_or_path)
     if path.startswith('http'):
+        import urllib.request  # slow to import, and most scripts only ever read from disk
         response = urllib.request.urlopen(path)
         return response.read().decode('utf-8')
     else:
         with open(path) as f:
             return f.read()
 
+@contextmanager
+def open_from_web_or_disk(url_or_path: Union[Path, str]) -> Iterator[BinaryIO]:
+    """Like read_from_web_or_disk(), but hands you a binary stream to read incrementally rather than the complete text"""
+    path = str(url_or_path)
+    if path.startswith('http'):
+        import urllib.request
+        stream = urllib.request.urlopen(path)
+    else:
+        stream = open(path, 'rb')
+    try:
+        yield stream
+    finally:
+        stream.close()
+
 def subdirectories(dir: Pathlike) -> Iterable[Path]:
     assert Path(dir).is_dir(), 'Directory %s does not exist' % dir
     return (d for d in Path(dir).glob('*') if d.is_dir())
@@ -133,9 +148,14 @@ def read_binary(p: Pathlike) -> bytes:
     return Path(p).open('rb').read()
 
 
-def md5_hash(file_path_or_binary_data: Union[Path, bytes]) -> str:
+def md5_hash(file_path_or_binary_data: Union[Path, bytes], chunk_size_bytes: int=1024 * 1024) -> str:
+    """Files are hashed in chunks, so you can hash huge files without reading them into memory"""
     assert not isinstance(file_path_or_binary_data, str), 'str type is ambiguous: did you mean this as a file path or binary data?'
     if isinstance(file_path_or_binary_data, Path):
-        return md5_hash(read_binary(file_path_or_binary_data))
+        hasher = hashlib.md5()
+        with file_path_or_binary_data.open('rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size_bytes), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
     return hashlib.md5(file_path_or_binary_data).hexdigest()
 
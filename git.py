@@ -2,11 +2,15 @@
 """A wrapper for commandline Git tools"""
 
 import logging
+import os
+import subprocess
+from collections import defaultdict, namedtuple
 from pathlib import Path
 from subprocess import CalledProcessError
-from typing import List, Optional, FrozenSet
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
 
-from utils.data_processing import checked_subprocess, remove_none
+from utils.data_processing import checked_subprocess
+from utils.files import Pathlike
 
 
 def git(*args, **kwargs) -> str:
@@ -19,26 +23,116 @@ def git(*args, **kwargs) -> str:
     return result.stdout if result.stdout else result.stderr
 
 
+GitChange = namedtuple('GitChange', ['status', 'path', 'old_path'])  # old_path is only set for renames & copies
+
+_git_status_kinds = {'A': 'added', 'M': 'modified', 'D': 'deleted', 'R': 'renamed', 'C': 'copied', 'T': 'type_changed', 'U': 'unmerged'}
+
+def parse_name_status_z(name_status_z: str) -> List[GitChange]:
+    r"""
+    Parses the output of `git diff --name-status -z`, which is robust to paths containing spaces, tabs, newlines, etc.
+
+    >>> parse_name_status_z('M\0a file.txt\0R100\0old\tname\0new name\0D\0gone\0')
+    [GitChange(status='modified', path=PosixPath('a file.txt'), old_path=None), GitChange(status='renamed', path=PosixPath('new name'), old_path=PosixPath('old\tname')), GitChange(status='deleted', path=PosixPath('gone'), old_path=None)]
+    """
+    fields = name_status_z.split('\0')
+    changes = []
+    idx = 0
+    while idx < len(fields) and fields[idx]:
+        status = _git_status_kinds.get(fields[idx][0], fields[idx])
+        if fields[idx][0] in 'RC':  # renames & copies come with a similarity score, then the source & destination paths
+            changes.append(GitChange(status, Path(fields[idx + 2]), Path(fields[idx + 1])))
+            idx += 3
+        else:
+            changes.append(GitChange(status, Path(fields[idx + 1]), None))
+            idx += 2
+    return changes
+
+
+def git_changes(from_commit: str, to_commit: str, cwd: Optional[Pathlike]=None) -> List[GitChange]:
+    """All the files added, modified, deleted, renamed, etc. between the commits (with paths relative to the repo root)"""
+    return parse_name_status_z(git('diff', '--name-status', '-z', '-M', from_commit, to_commit, **({'cwd': cwd} if cwd else {})))
+
+
 def git_modified_files(from_commit: str, to_commit: str) -> List[Path]:
-    def get_modified_path(status_and_name: str) -> Optional[Path]:
-        """
-        Returns the path relative to the repo root (or none, if this status doesn't represent a modification).
-
-        Examples of what status_and_name might look like:
-        M       _converters_/ObjConverter
-        A       resources/android/library/scenery_packs/sim objects/apt_vehicles/pushback/GT110_NML.etc
-        R100    setup_git.sh    scripts/setup_git.sh
-        D       resources/common_ios/apt_nav_dat/earth_awy.dat
-        """
-        if status_and_name[0] == 'M':
-            return Path(status_and_name.replace('M', '', 1).strip())
+    """Just the modified files (not additions, deletions or renames); see git_changes() for the rest"""
+    return [change.path for change in git_changes(from_commit, to_commit) if change.status == 'modified']
+
+
+def _repo_root(cwd: Optional[Pathlike]=None) -> Path:
+    return Path(git('rev-parse', '--show-toplevel', **({'cwd': cwd} if cwd else {})).strip())
+
+def _hash_worktree_files(repo_root: Path, paths: List[Path], batch_size: int=500) -> List[str]:
+    """
+    Blob IDs for files as they are in the worktree, computed by one git process per batch.
+    Paths go on the command line (rather than --stdin-paths, which is newline-delimited) so any file name works.
+    """
+    return [blob_id
+            for start in range(0, len(paths), batch_size)
+            for blob_id in git('hash-object', '--', *(p.as_posix() for p in paths[start:start + batch_size]), cwd=repo_root).split()]
+
+def _is_null_sha(sha: str) -> bool:
+    return not sha.strip('0')
+
+
+def git_blob_ids(cwd: Optional[Pathlike]=None) -> Dict[Path, str]:
+    """
+    The blob ID (content hash) of every tracked file as it currently is in the worktree.
+    These come straight from the index, which git keeps stat-validated, so only files that are dirty
+    in the worktree actually get read & hashed---making these very cheap content keys.
+    """
+    repo_root = _repo_root(cwd)
+    out = {}
+    for entry in git('ls-files', '--stage', '-z', cwd=repo_root).split('\0'):
+        if entry:
+            mode_sha_stage, path = entry.split('\t', 1)
+            out[Path(path)] = mode_sha_stage.split()[1]
+
+    dirty = []
+    for change in _parse_raw_z(git('diff', '--raw', '-z', '--no-renames', '--no-abbrev', cwd=repo_root)):
+        if change.blob_id is None:
+            out.pop(change.path, None)
         else:
-            return None
+            dirty.append(change.path)
+    out.update(zip(dirty, _hash_worktree_files(repo_root, dirty)))
+    return out
+
+
+BlobChange = namedtuple('BlobChange', ['path', 'blob_id'])  # blob_id is None for deletions, or all zeros if git didn't hash the worktree file
+
+def _parse_raw_z(raw_z: str) -> List[BlobChange]:
+    r"""
+    Parses `git diff --raw -z --no-renames`
+
+    >>> _parse_raw_z(':100644 100644 aaaa bbbb M\0foo bar\0:100644 000000 cccc 0000 D\0gone\0')
+    [BlobChange(path=PosixPath('foo bar'), blob_id='bbbb'), BlobChange(path=PosixPath('gone'), blob_id=None)]
+    """
+    fields = raw_z.split('\0')
+    return [BlobChange(Path(path), None if info.split()[4] == 'D' else info.split()[3])
+            for info, path in zip(fields[0::2], fields[1::2])
+            if info.startswith(':')]
 
-    return remove_none(
-        map(get_modified_path,
-            git('diff', '--name-status', from_commit, to_commit).splitlines(keepends=False))
-    )
+
+def git_changed_since(commit: str, cwd: Optional[Pathlike]=None, include_untracked: bool=False) -> Dict[Path, Optional[str]]:
+    """
+    The exact set of files that differ between the commit (e.g., the HEAD recorded at the end of your last run)
+    and the current worktree, mapped to their current blob IDs (None if deleted). Use the blob IDs as cheap content
+    keys, rather than re-hashing files or trusting mtimes (which every checkout resets).
+    Paths are relative to the repo root.
+    """
+    repo_root = _repo_root(cwd)
+    changes = _parse_raw_z(git('diff', '--raw', '-z', '--no-renames', '--no-abbrev', commit, cwd=repo_root))
+    out = {change.path: change.blob_id for change in changes}
+    # Git only reports blob IDs it already knew from the index; anything dirty in the worktree we need to hash
+    unhashed = [path for path, blob_id in out.items() if blob_id is not None and _is_null_sha(blob_id)]
+    if include_untracked:
+        unhashed += [Path(path) for path in git('ls-files', '--others', '--exclude-standard', '-z', cwd=repo_root).split('\0') if path]
+    out.update(zip(unhashed, _hash_worktree_files(repo_root, unhashed)))
+    return out
+
+
+def git_head_sha(cwd: Optional[Pathlike]=None) -> str:
+    """Record this at the end of a run to pass to git_changed_since() next time"""
+    return git('rev-parse', 'HEAD', **({'cwd': cwd} if cwd else {})).strip()
 
 
 def git_current_branch() -> str:
@@ -56,3 +150,100 @@ def git_tags_for_commit(sha_or_name: str) -> List[str]:
 
 def git_create_tag(new_tag: str, capture_stdout: bool=True):
     git('tag', new_tag, capture_stdout=capture_stdout)
+
+
+class GitRepo:
+    """
+    A long-lived handle on a repo, for scripts that query git in loops. Object lookups go through a single
+    persistent `git cat-file --batch` process, tag queries are answered from one `for-each-ref` call, and
+    results are cached until HEAD or any ref changes (e.g., a commit, checkout, or new tag).
+    """
+    def __init__(self, repo_dir: Pathlike='.'):
+        self.repo_dir = Path(repo_dir)
+        self.git_dir = Path(self._git('rev-parse', '--absolute-git-dir').strip())
+        # In a linked worktree, git_dir is .git/worktrees/<name> (with its own HEAD), but refs & packed-refs are shared
+        self.common_dir = (self.repo_dir / self._git('rev-parse', '--git-common-dir').strip()).resolve()
+        self._cat_file: Optional[subprocess.Popen] = None
+        self._cache: Dict[Any, Any] = {}
+        self._cached_refs_state = None
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+    def close(self):
+        if self._cat_file:
+            self._cat_file.stdin.close()
+            self._cat_file.wait()
+            self._cat_file = None
+
+    def _git(self, *args) -> str:
+        return git(*args, cwd=self.repo_dir)
+
+    def _refs_state(self) -> Tuple[int, ...]:
+        """Cheap to check: ref updates are written via lock file + rename, which bumps the mtime of the containing directory"""
+        def mtime_ns(p: Path) -> int:
+            try:
+                return p.stat().st_mtime_ns
+            except FileNotFoundError:
+                return 0
+        ref_dirs = [Path(dir_path) for dir_path, _dirs, _files in os.walk(self.common_dir / 'refs')]
+        return tuple(mtime_ns(p) for p in [self.git_dir / 'HEAD', self.common_dir / 'packed-refs'] + ref_dirs)
+
+    def _cached(self, key: Any, compute: Callable[[], Any]) -> Any:
+        """Memoizes compute() until the refs change. Checking costs a walk of the refs dir, so do it once per public call."""
+        refs_state = self._refs_state()
+        if refs_state != self._cached_refs_state:
+            self._cache.clear()
+            self._cached_refs_state = refs_state
+        return self._memoized(key, compute)
+
+    def _memoized(self, key: Any, compute: Callable[[], Any]) -> Any:
+        """Like _cached(), but trusts that the caller has already checked the refs haven't changed"""
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def cat_file(self, object_name: str) -> Optional[Tuple[str, str, bytes]]:
+        """@return The object's full SHA, type & content, or None if there's no such object"""
+        if not self._cat_file:
+            self._cat_file = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=str(self.repo_dir),
+                                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._cat_file.stdin.write(object_name.encode('utf-8') + b'\n')
+        self._cat_file.stdin.flush()
+        header = self._cat_file.stdout.readline().decode('utf-8').split()
+        if len(header) != 3:  # e.g., "<name> missing" or "<name> ambiguous"
+            return None
+        sha, object_type, size = header
+        content = self._cat_file.stdout.read(int(size) + 1)[:-1]  # content is followed by a newline
+        return sha, object_type, content
+
+    def commit_sha(self, sha_or_name: str) -> Optional[str]:
+        """Resolves a branch, tag, etc. to the full SHA of the commit it points at (peeling annotated tags)"""
+        obj = self.cat_file(f'{sha_or_name}^{{commit}}')
+        return obj[0] if obj else None
+
+    def current_branch(self) -> str:
+        return self._cached('current_branch', lambda: self._git('rev-parse', '--abbrev-ref', 'HEAD').strip())
+
+    def tags_by_commit(self) -> Dict[str, List[str]]:
+        """Maps each tagged commit's SHA to its tags"""
+        def compute() -> Dict[str, List[str]]:
+            out = defaultdict(list)
+            # %(*objectname) is the commit an annotated tag points at; it's empty for lightweight tags
+            for line in self._git('for-each-ref', '--format=%(objectname) %(*objectname) %(refname:strip=2)', 'refs/tags').splitlines():
+                object_sha, peeled_sha, tag = line.split(' ', 2)
+                out[peeled_sha or object_sha].append(tag)
+            return dict(out)
+        return self._cached('tags_by_commit', compute)
+
+    def all_tags(self) -> FrozenSet[str]:
+        return frozenset(tag for tags in self.tags_by_commit().values() for tag in tags)
+
+    def tags_for_commits(self, shas_or_names: Iterable[str]) -> Dict[str, List[str]]:
+        """Tags for many commits at once: maps each commit you asked about (as you named it) to its tags"""
+        tags_by_commit = self.tags_by_commit()  # checks the refs once for the whole batch
+        return {name: tags_by_commit.get(self._memoized(('commit_sha', name), lambda: self.commit_sha(name)), [])
+                for name in shas_or_names}
+
+    def changes(self, from_commit: str, to_commit: str) -> List[GitChange]:
+        return self._cached(('changes', from_commit, to_commit), lambda: git_changes(from_commit, to_commit, cwd=self.repo_dir))
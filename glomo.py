@@ -1,11 +1,33 @@
+"""
+Reading, writing and fetching the component manifests (directory.txt) used by our installer & updater.
+
+Importing this module stays cheap: requests, multiprocessing and friends are only imported by the functions that use them
+(see import_cost.py).
+"""
+import bisect
+import fnmatch
+import functools
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import os
+import platform
+import re
+import shutil
+import tempfile
+import traceback
+from array import array
 from collections import defaultdict, namedtuple
+from contextlib import contextmanager, suppress
 from dataclasses import dataclass
+from operator import itemgetter
 from urllib.error import URLError
 from pathlib import Path
-from typing import List, Iterable, Dict, Optional, Tuple, DefaultDict
-from utils.files import read_from_web_or_disk, Pathlike
-from utils.highwinds_cdn import CdnServer
+from typing import List, Iterable, Iterator, Dict, Optional, Tuple, DefaultDict, Union, BinaryIO, Callable
+from utils.files import read_from_web_or_disk, open_from_web_or_disk, files_recursive, md5_hash, Pathlike
+from utils.highwinds_cdn import CdnServer, pooled_session, sign_secured_url
 
 
 @dataclass
@@ -72,12 +94,253 @@ def component_versions(components: Iterable[ComponentBlock]) -> Dict[str, List[i
 
 
 ManifestHistory = namedtuple('ManifestHistory', ['version'])  # the most *recent* manifest version which touched this file for a modification or delete
+ManifestZip = namedtuple('ManifestZip', ['hash'])  # a ZIP line in the manifest: the hash of the archive itself
 
 @dataclass
 class ManifestEntry:
     hash: str
     in_zip: Optional[Path]=None  # None if this is a RAWFILE, or the path of the ZIP this is contained in
 
+ManifestRecord = Union[ManifestEntry, ManifestZip, ManifestHistory]
+
+
+# I'm sorry to whomever needs to maintain this...including you future-Chris...but for some reason I found it easier
+# to use REGEX to parse this manifest file than normal string utilities and so....here we are. I will say, 99% of the
+# matching is REGEX 101 with two exceptions:
+#   1) Matching floating point values = ([+-]?(?:[0-9]*[.])?[0-9]+)
+#   2) Matching space-escaped strings like our paths which may have Earth\ Nav\ Data for example. We don't want to see those spaces as whitespace and so we have = ((?:[^\\\s]|\\.)+)
+# Feel free to insult and scathe me for it but I'm at least making SOME attempt to document this so...I'm not a complete asshole.
+_manifest_version_re = re.compile(r'^MANIFEST_VERSION\s+([0-9]+)\s*$')
+_install_path_prefix_re = re.compile(r'^INSTALL_PATH_PREFIX\s+(.*)')
+_rawfile_re = re.compile(r'^RAWFILE\s+([-+]?\d+)\s+([-+]?\d+)\s+([-+]?\d+)\s+([-+]?\d+)\s+(\S+)\s+([+-]?(?:[0-9]*[.])?[0-9]+)\s+(\S+)\s+((?:[^\\\s]|\\.)+)\s+((?:[^\\\s]|\\.)+)')
+_zip_re = re.compile(r'^ZIP\s+([+-]?(?:[0-9]*[.])?[0-9]+)\s+(\S+)\s+((?:[^\\\s]|\\.)+)\s+((?:[^\\\s]|\\.)+)')
+_zipfile_re = re.compile(r'^ZIPFILE\s+([-+]?\d+)\s+([-+]?\d+)\s+([-+]?\d+)\s+([-+]?\d+)\s+(\S+)\s+([+-]?(?:[0-9]*[.])?[0-9]+)\s+(\S+)\s+(.+)')
+_file_history_re = re.compile(r'^FILE_HISTORY\s+([0-9]+)\s+(.+)')
+
+
+def unescape_spaces(pathlike: Pathlike) -> Path:
+    return Path(str(pathlike).replace("\\ ", " "))
+
+
+def _parse_manifest_body_line(line: str, most_recent_zip: Optional[Path]) -> Optional[Tuple[Path, ManifestRecord]]:
+    """
+    Parses a single line following the manifest header.
+    @param most_recent_zip The ZIP whose ZIPFILE lines we're currently reading (None if we haven't seen a ZIP yet)
+    @return The path the line describes plus its record, or None if this isn't a line we care about
+    """
+    if line.startswith("ZIP") or line.startswith("ZIPFILE") or line.startswith("RAWFILE"):
+        # Check for RAWFILE line
+        match_obj = _rawfile_re.match(line)
+        if match_obj and len(match_obj.groups()) == 9:
+            return unescape_spaces(match_obj.group(8)), ManifestEntry(hash=match_obj.group(7))
+
+        # Check for ZIP line
+        match_obj = _zip_re.match(line)
+        if match_obj and len(match_obj.groups()) == 4:
+            return unescape_spaces(match_obj.group(3)), ManifestZip(match_obj.group(2))
+
+        # Check for ZIPFILE line
+        match_obj = _zipfile_re.match(line)
+        if match_obj and len(match_obj.groups()) == 8:
+            assert most_recent_zip, 'This ZIPFILE does not seem to be contained in a ZIP...?'
+            return unescape_spaces(match_obj.group(8)), ManifestEntry(hash=match_obj.group(7), in_zip=most_recent_zip)
+
+        raise RuntimeError("We either found a mal-formed manifest line, or this parser has a bug. The line was:\n" + line)
+    elif line.startswith("FILE_HISTORY"):
+        match_obj = _file_history_re.match(line)
+        if match_obj and len(match_obj.groups()) == 2:
+            return Path(match_obj.group(2)), ManifestHistory(int(match_obj.group(1)))
+    return None
+
+
+def _lines_with_offsets(stream: BinaryIO) -> Iterator[Tuple[int, str]]:
+    """Yields each line of the binary stream (without line endings) along with the byte offset at which it starts"""
+    offset = 0
+    for raw_line in stream:
+        yield offset, raw_line.decode('utf-8').rstrip('\r\n')
+        offset += len(raw_line)
+
+
+class ManifestReader:
+    """
+    Streams a directory.txt manifest from disk or the web one line at a time, so that peak memory use doesn't
+    grow with the size of the manifest. Use records() or entries() to walk the whole thing, or index() if you
+    only need to look up a handful of paths or ZIPs.
+    """
+    def __init__(self, manifest_file_path_or_url: Optional[Pathlike]):
+        self.source = manifest_file_path_or_url
+        self.version: Optional[int] = None  # filled in as soon as we've read past the header
+        self.install_path_prefix: Optional[Path] = None
+
+    def records(self) -> Iterator[Tuple[Path, ManifestRecord]]:
+        """Yields every RAWFILE, ZIP, ZIPFILE and FILE_HISTORY line as it's parsed"""
+        with open_from_web_or_disk(self.source) as stream:
+            for _offset, path, record in self._records_with_offsets(_lines_with_offsets(stream)):
+                yield path, record
+
+    def parse_lines(self, lines: Iterable[str]) -> Iterator[Tuple[Path, ManifestRecord]]:
+        """Like records(), but for manifest lines you've gotten from somewhere other than our source"""
+        for _offset, path, record in self._records_with_offsets(enumerate(lines)):
+            yield path, record
+
+    def entries(self) -> Iterator[Tuple[Path, ManifestEntry]]:
+        """Yields the path on disk and manifest entry of every RAWFILE and ZIPFILE, in file order"""
+        return ((path, record) for path, record in self.records() if isinstance(record, ManifestEntry))
+
+    def header(self) -> Tuple[int, Path]:
+        """Reads only as far as the first record to get the manifest version and install path prefix"""
+        for _ in self.records():
+            break
+        assert self.version is not None, 'Manifest was missing a version'
+        assert self.install_path_prefix is not None, 'Manifest was missing an install path prefix'
+        return self.version, self.install_path_prefix
+
+    def index(self) -> 'ManifestIndex':
+        return ManifestIndex(self)
+
+    def _records_with_offsets(self, lines: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, Path, ManifestRecord]]:
+        self.version = None
+        self.install_path_prefix = None
+        most_recent_zip: Optional[Path] = None
+        for offset, line in lines:
+            # Look at each line for the version number. Until we find it, we don't care about anything else!
+            if self.version is None:
+                match_obj = _manifest_version_re.match(line)
+                if match_obj:
+                    self.version = int(match_obj.group(1))
+            # A NOTE ABOUT 'install_path_prefix':
+            #
+            # Chris says: We don't want the install path prepended before any of the externally visible paths! It is only relevant on the CLIENT device when it's installed. The server paths have no
+            # relation to the install_path despite the fact that it may SEEM as though they are in lock-step (because they often are). As I write this, we have a new and an old 737 on the server in different
+            # paths. One will only work for an old install of the sim and the other will only work for a new install, but they both have the same install_path_prefix, component name etc. This is
+            # normal operation and it's why the component list allows for different paths between components with the same name. It is the COMPONENT's path that needs to be prepended...not the install_path_prefix...
+            # but that happens outside of this class when components do stuff with this manifest data.
+            #
+            elif not self.install_path_prefix and line.startswith("INSTALL_PATH_PREFIX"):
+                match_obj = _install_path_prefix_re.match(line)
+                if match_obj:
+                    self.install_path_prefix = unescape_spaces(match_obj.group(1))
+            else:
+                parsed = _parse_manifest_body_line(line, most_recent_zip)
+                if parsed:
+                    path, record = parsed
+                    if isinstance(record, ManifestZip):
+                        most_recent_zip = path
+                    yield offset, path, record
+
+
+def _sorted_pairs(keys: array, values: array, run_length: int=4096) -> Tuple[array, array]:
+    """
+    Stably sorts the (key, value) pairs by key. Sorting everything at once would cost a Python object per pair,
+    so we sort a run at a time in place, then merge the runs.
+
+    >>> _sorted_pairs(array('q', [3, 1, 2, 1]), array('q', [0, 1, 2, 3]), run_length=2)
+    (array('q', [1, 1, 2, 3]), array('q', [1, 3, 2, 0]))
+    """
+    starts = range(0, len(keys), run_length)
+    for start in starts:
+        run = sorted(zip(keys[start:start + run_length], values[start:start + run_length]), key=itemgetter(0))
+        keys[start:start + run_length] = array(keys.typecode, (key for key, _ in run))
+        values[start:start + run_length] = array(values.typecode, (value for _, value in run))
+
+    runs = [zip(itertools.islice(keys, start, start + run_length), itertools.islice(values, start, start + run_length)) for start in starts]
+    sorted_keys, sorted_values = array(keys.typecode), array(values.typecode)
+    for key, value in heapq.merge(*runs, key=itemgetter(0)):  # ties come out in run order, so this stays stable
+        sorted_keys.append(key)
+        sorted_values.append(value)
+    return sorted_keys, sorted_values
+
+
+class ManifestIndex:
+    """
+    An on-demand index of the byte offset of each line in a manifest, for random lookups by path or by ZIP
+    without materializing the entries. Remote manifests get spooled (in chunks) to a temp file first.
+
+    We key the offsets on the hash of the path rather than the path itself, and keep (hash, offset) pairs in
+    parallel arrays sorted by hash, so the index costs 16 bytes per line no matter how long the paths are.
+    Lookups re-read and re-parse the line, so hash collisions can't give you the wrong entry.
+    """
+    def __init__(self, reader: ManifestReader):
+        source = str(reader.source)
+        if source.startswith('http'):
+            self._file = tempfile.TemporaryFile()
+            with open_from_web_or_disk(source) as stream:
+                shutil.copyfileobj(stream, self._file)
+            self._file.seek(0)
+        else:
+            self._file = open(source, 'rb')
+
+        path_hashes = array('q')
+        path_offsets = array('q')
+        self._zip_offsets: Dict[Path, int] = {}
+        self._zip_starts = array('q')  # sorted, since we read in file order
+        for offset, path, record in reader._records_with_offsets(_lines_with_offsets(self._file)):
+            if isinstance(record, ManifestZip):
+                self._zip_offsets[path] = offset
+                self._zip_starts.append(offset)
+            else:
+                path_hashes.append(hash(str(path)))
+                path_offsets.append(offset)
+        self._path_hashes, self._path_offsets = _sorted_pairs(path_hashes, path_offsets)
+        self.version = reader.version
+        self.install_path_prefix = reader.install_path_prefix
+        assert self.version is not None, 'Manifest was missing a version'
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+    def close(self): self._file.close()
+
+    def entries_for(self, path: Pathlike) -> List[ManifestEntry]:
+        """All the places this path on disk shows up in the manifest (as a RAWFILE or in any number of ZIPs)"""
+        return [record for record in self._records_for(path) if isinstance(record, ManifestEntry)]
+
+    def history_for(self, path: Pathlike) -> Optional[ManifestHistory]:
+        return next((record for record in self._records_for(path) if isinstance(record, ManifestHistory)), None)
+
+    def zips(self) -> List[Path]:
+        return list(self._zip_offsets)
+
+    def zip_hash(self, zip_path: Pathlike) -> Optional[str]:
+        offset = self._zip_offsets.get(Path(zip_path))
+        return None if offset is None else self._record_at(offset)[1].hash
+
+    def zip_contents(self, zip_path: Pathlike) -> List[Tuple[Path, ManifestEntry]]:
+        """
+        Reads just the ZIPFILE lines belonging to this ZIP. We read them all up front rather than yielding as we go,
+        since every other lookup seeks the same file handle out from under us.
+        """
+        zip_path = Path(zip_path)
+        if zip_path not in self._zip_offsets:
+            raise KeyError(f'No ZIP {zip_path} in this manifest')
+        self._file.seek(self._zip_offsets[zip_path])
+        self._file.readline()  # skip the ZIP line itself
+        contents = []
+        for line in self._file:
+            parsed = _parse_manifest_body_line(line.decode('utf-8').rstrip('\r\n'), zip_path)
+            if parsed:
+                path, record = parsed
+                if isinstance(record, ManifestZip):  # on to the next ZIP
+                    break
+                elif isinstance(record, ManifestEntry) and record.in_zip:
+                    contents.append((path, record))
+        return contents
+
+    def _records_for(self, path: Pathlike) -> List[ManifestRecord]:
+        path = Path(path)
+        path_hash = hash(str(path))
+        start = bisect.bisect_left(self._path_hashes, path_hash)
+        end = bisect.bisect_right(self._path_hashes, path_hash, lo=start)
+        return [record
+                for record_path, record in map(self._record_at, self._path_offsets[start:end])
+                if record_path == path]
+
+    def _record_at(self, offset: int) -> Tuple[Path, ManifestRecord]:
+        zip_idx = bisect.bisect_right(self._zip_starts, offset) - 1
+        containing_zip = self._record_at(self._zip_starts[zip_idx])[0] if zip_idx >= 0 and self._zip_starts[zip_idx] != offset else None
+        self._file.seek(offset)
+        return _parse_manifest_body_line(self._file.readline().decode('utf-8').rstrip('\r\n'), containing_zip)
+
+
 @dataclass(frozen=True)
 class ComponentManifest:
     """Represents the directory.txt manifest for a component, with both the hashes of current files and the file history"""
@@ -93,93 +356,62 @@ class ComponentManifest:
                 for path, locations in self.entries.items()
                 for entry in locations]
 
-    # I'm sorry to whomever needs to maintain this...including you future-Chris...but for some reason I found it easier
-    # to use REGEX to parse this manifest file than normal string utilities and so....here we are. I will say, 99% of the
-    # matching is REGEX 101 with two exceptions:
-    #   1) Matching floating point values = ([+-]?(?:[0-9]*[.])?[0-9]+)
-    #   2) Matching space-escaped strings like our paths which may have Earth\ Nav\ Data for example. We don't want to see those spaces as whitespace and so we have = ((?:[^\\\s]|\\.)+)
-    # Feel free to insult and scathe me for it but I'm at least making SOME attempt to document this so...I'm not a complete asshole.
     @classmethod
     def from_file(cls, manifest_file_path_or_url: Optional[Pathlike]) -> Optional['ComponentManifest']:
-        import re
+        if not manifest_file_path_or_url:  # no file given
+            return None
 
-        prev_manifest_version: Optional[int] = None
-        install_path_prefix: Optional[Path] = None
+        reader = ManifestReader(manifest_file_path_or_url)
+        return cls._from_records(reader, reader.records())
+
+    @classmethod
+    def from_text(cls, manifest_text: str) -> 'ComponentManifest':
+        """Parses a manifest you've already got in memory (e.g., an HTTP response body)"""
+        reader = ManifestReader(None)
+        return cls._from_records(reader, reader.parse_lines(manifest_text.splitlines()))
+
+    @classmethod
+    def _from_records(cls, reader: ManifestReader, records: Iterable[Tuple[Path, ManifestRecord]]) -> 'ComponentManifest':
         entries = defaultdict(list)
         history = dict()
         zips = dict()
+        for path, record in records:
+            if isinstance(record, ManifestZip):
+                zips[path] = record.hash
+            elif isinstance(record, ManifestHistory):
+                assert path not in history, f'Founnd duplicate history entry for {path}\nHistory entry should only be the most *recent* manifest version which touched this file for a modification or delete.'
+                history[path] = record
+            elif record.in_zip:
+                assert not any(mfst_entry.in_zip == record.in_zip for mfst_entry in entries[path]), f'File {path} must be unique within the ZIP {record.in_zip}'
+                entries[path].append(record)
+            else:
+                assert all(entry.in_zip for entry in entries[path]), f'Duplicated raw file {path}'
+                entries[path].append(record)
 
-        if manifest_file_path_or_url:
-            most_recent_zip: Optional[Path] = None
-            for line in read_from_web_or_disk(manifest_file_path_or_url).splitlines():
-                # Look at each line for the version number. Until we find it, we don't care about anything else!
-                if prev_manifest_version is None:
-                    match_obj = re.match(r'^MANIFEST_VERSION\s+([0-9]+)\s*$', str(line))
-                    if match_obj:
-                        prev_manifest_version = int(match_obj.group(1))
-                        continue
-                else:
-                    line.strip()
-                    # A NOTE ABOUT 'install_path_prefix':
-                    #
-                    # Chris says: We don't want the install path prepended before any of the externally visible paths! It is only relevant on the CLIENT device when it's installed. The server paths have no
-                    # relation to the install_path despite the fact that it may SEEM as though they are in lock-step (because they often are). As I write this, we have a new and an old 737 on the server in different
-                    # paths. One will only work for an old install of the sim and the other will only work for a new install, but they both have the same install_path_prefix, component name etc. This is
-                    # normal operation and it's why the component list allows for different paths between components with the same name. It is the COMPONENT's path that needs to be prepended...not the install_path_prefix...
-                    # but that happens outside of this class when components do stuff with this manifest data.
-                    #
-
-                    # Now look at each line and see if it's an install path prefix
-                    if not install_path_prefix and line.startswith("INSTALL_PATH_PREFIX"):
-                        match_obj = re.match(r'^INSTALL_PATH_PREFIX\s+(.*)', str(line))
-                        if match_obj:
-                            install_path_prefix = cls.unescape_spaces(str(match_obj.group(1)))
-                            continue
-                    elif line.startswith("ZIP") or line.startswith("ZIPFILE") or line.startswith("RAWFILE"):
-                        # Check for RAWFILE line
-                        match_obj = re.match(r'^RAWFILE\s+([-+]?\d+)\s+([-+]?\d+)\s+([-+]?\d+)\s+([-+]?\d+)\s+(\S+)\s+([+-]?(?:[0-9]*[.])?[0-9]+)\s+(\S+)\s+((?:[^\\\s]|\\.)+)\s+((?:[^\\\s]|\\.)+)', str(line))
-                        if match_obj and len(match_obj.groups()) == 9:
-                            path = cls.unescape_spaces(match_obj.group(8))
-                            #path = cls.unescape_spaces(install_path_prefix / match_obj.group(8))
-                            assert all(entry.in_zip for entry in entries[path]), f'Duplicated raw file {path}'
-                            entries[path].append(ManifestEntry(hash=match_obj.group(7)))
-                            continue
-
-                        # Check for ZIP line
-                        match_obj = re.match(r'^ZIP\s+([+-]?(?:[0-9]*[.])?[0-9]+)\s+(\S+)\s+((?:[^\\\s]|\\.)+)\s+((?:[^\\\s]|\\.)+)', str(line))
-                        if match_obj and len(match_obj.groups()) == 4:
-                            most_recent_zip = cls.unescape_spaces(match_obj.group(3))
-                            #most_recent_zip = Path(install_path_prefix) / cls.unescape_spaces(match_obj.group(3))
-                            zips[most_recent_zip] = match_obj.group(2)
-                            continue
-
-                        # Check for ZIPFILE line
-                        match_obj = re.match(r'^ZIPFILE\s+([-+]?\d+)\s+([-+]?\d+)\s+([-+]?\d+)\s+([-+]?\d+)\s+(\S+)\s+([+-]?(?:[0-9]*[.])?[0-9]+)\s+(\S+)\s+(.+)', str(line))
-                        if match_obj and len(match_obj.groups()) == 8:
-                            assert most_recent_zip, 'This ZIPFILE does not seem to be contained in a ZIP...?'
-                            path = cls.unescape_spaces(match_obj.group(8))
-                            #path = cls.unescape_spaces(install_path_prefix / match_obj.group(8))
-                            assert not any(mfst_entry.in_zip == most_recent_zip for mfst_entry in entries[path]), f'File {path} must be unique within the ZIP {most_recent_zip}'
-                            entries[path].append(ManifestEntry(hash=match_obj.group(7), in_zip=most_recent_zip))
-                            continue
-
-                        raise RuntimeError("We either found a mal-formed manifest line, or this parser has a bug. The line was:\n" + line)
-                    elif line.startswith("FILE_HISTORY"):
-                        match_obj = re.match(r'^FILE_HISTORY\s+([0-9]+)\s+(.+)', str(line))
-                        if match_obj and len(match_obj.groups()) == 2:
-                            path = Path(match_obj.group(2))
-                            assert path not in history, f'Founnd duplicate history entry for {path}\nHistory entry should only be the most *recent* manifest version which touched this file for a modification or delete.'
-                            history[path] = ManifestHistory(int(match_obj.group(1)))
-                            continue
-
-            assert prev_manifest_version is not None, 'Manifest was missing a version'
-            assert install_path_prefix is not None, 'Manifest was missing an install path prefix'
-            assert entries, 'No entries for manifest... this will not be a very useful component!'
-            for disk_path, manifest_entries in entries.items():
-                assert len(set(entry.hash for entry in manifest_entries)) <= 1, f'The same file ({disk_path}) wound up with different hashes... Huh?'
-            return cls(prev_manifest_version, Path(install_path_prefix), entries, history, zips)
-        else:  # no file given
-            return None
+        assert reader.version is not None, 'Manifest was missing a version'
+        assert reader.install_path_prefix is not None, 'Manifest was missing an install path prefix'
+        assert entries, 'No entries for manifest... this will not be a very useful component!'
+        for disk_path, manifest_entries in entries.items():
+            assert len(set(entry.hash for entry in manifest_entries)) <= 1, f'The same file ({disk_path}) wound up with different hashes... Huh?'
+        return cls(reader.version, Path(reader.install_path_prefix), entries, history, zips)
+
+    def _to_compact(self) -> 'CompactManifest':
+        return (self.version, str(self.install_path_prefix),
+                [(str(path), entry.hash, str(entry.in_zip) if entry.in_zip else None) for path, entry in self.all_paths_all_entries()],
+                [(str(zip_path), zip_hash) for zip_path, zip_hash in self.zips.items()],
+                [(str(path), record.version) for path, record in self.history.items()])
+
+    @classmethod
+    def _from_compact(cls, compact: 'CompactManifest') -> 'ComponentManifest':
+        """Skips _from_records()' validation: a compact manifest only ever comes from a ComponentManifest that passed it"""
+        version, install_path_prefix, compact_entries, compact_zips, compact_history = compact
+        zips = {Path(zip_path): zip_hash for zip_path, zip_hash in compact_zips}
+        zip_paths = {str(zip_path): zip_path for zip_path in zips}  # so all the entries in a ZIP share one Path
+        entries = defaultdict(list)
+        for path, entry_hash, in_zip in compact_entries:
+            entries[Path(path)].append(ManifestEntry(entry_hash, zip_paths[in_zip] if in_zip else None))
+        history = {Path(path): ManifestHistory(history_version) for path, history_version in compact_history}
+        return cls(version, Path(install_path_prefix), entries, history, zips)
 
     @classmethod
     def from_file_with_next_version(cls, manifest_file_path_or_url: Optional[Pathlike]) -> Tuple[Optional['ComponentManifest'], int]:
@@ -189,6 +421,343 @@ class ComponentManifest:
 
     @staticmethod
     def unescape_spaces(pathlike: Pathlike) -> Path:
-        return Path(str(pathlike).replace("\\ ", " "))
+        return unescape_spaces(pathlike)
+
+
+ComponentVersion = Tuple[str, int]  # component name & manifest version
+HttpTimeout = Tuple[float, float]  # seconds to wait to connect, and seconds to wait for each read from the server
+# A ComponentManifest as plain strs & ints---version, install path prefix, (path, hash, ZIP or None) entries, (ZIP, hash) zips,
+# and (path, version) history---which is ~50x cheaper to pickle across processes than the Path-keyed objects
+CompactManifest = Tuple[int, str, List[Tuple[str, str, Optional[str]]], List[Tuple[str, str]], List[Tuple[str, int]]]
+
+
+class FetchedManifest:
+    """The result of fetching one manifest. It's only turned into a ComponentManifest when you first ask for .manifest."""
+    def __init__(self, url: str, compact: Optional[CompactManifest]=None, error: Optional[str]=None):
+        self.url = url
+        self.status = 'failed' if error else 'fetched'
+        self.error = error  # the traceback, if this failed
+        self._compact = compact
+
+    @functools.cached_property
+    def manifest(self) -> Optional[ComponentManifest]:
+        return ComponentManifest._from_compact(self._compact) if self._compact else None
+
+    def __repr__(self):
+        return f'FetchedManifest({self.url!r}, status={self.status!r})'
+
+
+def _parse_compact_manifest(manifest_text: str) -> CompactManifest:
+    return ComponentManifest.from_text(manifest_text)._to_compact()
+
+
+def latest_manifest_version(component: ComponentBlock) -> List[int]:
+    return [max(component.manifest_versions)]
+
+def component_manifest_url(component: ComponentBlock, manifest_version: int, base_url: Optional[str]=None) -> str:
+    """@param base_url Overrides the component's CDN server (e.g., to point at a mirror or a local test server)"""
+    return f'{base_url or component.cdn_subdomain.base_url}{component.package_path}/{manifest_version}/directory.txt'
+
+def _signed_if_required(component: ComponentBlock, url: str) -> str:
+    """Call this up front, on the main thread, rather than from a worker: signing may need to prompt for the secret"""
+    return sign_secured_url(url) if component.require_auth else url
+
+def fetch_component_manifests(components: Iterable[ComponentBlock],
+                              versions_to_fetch: Callable[[ComponentBlock], Iterable[int]]=latest_manifest_version,
+                              manifest_url_for: Callable[[ComponentBlock, int], str]=component_manifest_url,
+                              max_connections: int=16,
+                              parse_processes: int=os.cpu_count(),
+                              timeout: HttpTimeout=(10, 60)) -> Dict[ComponentVersion, FetchedManifest]:
+    """
+    Fetches and parses the manifests for all your components (e.g., straight out of parse_component_list()) concurrently.
+    Downloads share a pool of keep-alive connections, and each body is handed off to a worker process for parsing
+    (and validation) as soon as it arrives, so refreshing the full catalog is bound by network latency rather than N round trips.
+
+    Workers hand back the compact form of each manifest, and we only build the ComponentManifest objects for the
+    manifests you actually look at (building them costs about as much as parsing the text in the first place).
+    A manifest that fails to download or parse (including a server that stalls for longer than the timeout) comes back
+    with status 'failed' rather than taking the others down with it.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed  # pulls in multiprocessing, which parsing the component list doesn't need
+
+    urls = {(component.component_name, version): _signed_if_required(component, manifest_url_for(component, version))
+            for component in components
+            for version in versions_to_fetch(component)}
+
+    with pooled_session(max_connections) as session:
+        def fetch(url: str) -> str:
+            response = session.get(url, timeout=timeout)
+            response.raise_for_status()
+            return response.content.decode('utf-8')
+
+        results: Dict[ComponentVersion, FetchedManifest] = {}
+        with ThreadPoolExecutor(max_connections) as fetchers, ProcessPoolExecutor(parse_processes) as parsers:
+            fetching = {fetchers.submit(fetch, url): component_version for component_version, url in urls.items()}
+            parsing = {}
+            for fetched in as_completed(fetching):
+                try:
+                    parsing[fetching[fetched]] = parsers.submit(_parse_compact_manifest, fetched.result())
+                except Exception:
+                    results[fetching[fetched]] = FetchedManifest(urls[fetching[fetched]], error=traceback.format_exc())
+            for component_version, parsed in parsing.items():
+                try:
+                    results[component_version] = FetchedManifest(urls[component_version], compact=parsed.result())
+                except Exception:
+                    results[component_version] = FetchedManifest(urls[component_version], error=traceback.format_exc())
+
+    for component_version, result in results.items():
+        if result.status == 'failed':
+            logging.error(f'Failed to fetch the manifest for {component_version[0]} version {component_version[1]} from {result.url}:\n{result.error}')
+    return {component_version: results[component_version] for component_version in urls}
+
+
+ZipRule = Tuple[str, Path]  # a glob (matched against the whole path relative to the component root) & the ZIP that matching files go in
+
+def build_component_manifest(component_root: Path, install_path_prefix: Pathlike,
+                             previous: Optional[ComponentManifest]=None,
+                             zip_rules: Iterable[ZipRule]=(),
+                             zip_archive_hash: Optional[Callable[[Path], str]]=None,
+                             stat_cache_path: Optional[Path]=None,
+                             hash_threads: int=os.cpu_count()) -> ComponentManifest:
+    """
+    Builds the next version of a component's manifest from the files on disk.
+
+    @param previous The currently published manifest, if any. The new manifest gets the next version number,
+                    and FILE_HISTORY is carried forward from it, bumped for every file added, modified or deleted.
+    @param zip_rules Each file goes in the ZIP of the first rule it matches, or is a RAWFILE if it matches none
+    @param zip_archive_hash Gives the MD5 of the archive you've built for a ZIP path, e.g.,
+                            lambda zip_path: md5_hash(built_zips_dir / zip_path). We don't build the ZIPs here, but
+                            clients verify the archives they download against these hashes, so this is required
+                            if any file lands in a ZIP.
+    @param stat_cache_path Where we remember the size, mtime & hash of every file we hashed last time. Files whose
+                           size and mtime haven't changed since get their hash from here rather than being re-read,
+                           so publishing a small change to a huge component only hashes what changed.
+                           Note that previous alone never saves any hashing: a manifest has no sizes or mtimes,
+                           so without this cache there's no way to tell an unchanged file from a modified one.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    assert component_root.is_dir(), f'No such directory {component_root}'
+    zip_rules = list(zip_rules)
+    version = previous.version + 1 if previous else 1
+    if previous and not stat_cache_path:
+        logging.warning('Without a stat_cache_path, we have to rehash every file, even those unchanged since the previous manifest')
+
+    stats = {path.relative_to(component_root): path.stat()
+             for path in files_recursive(component_root)
+             if not stat_cache_path or path.resolve() != stat_cache_path.resolve()}
+
+    cached: Dict[str, List] = json.loads(stat_cache_path.read_text()) if stat_cache_path and stat_cache_path.is_file() else {}
+    hashes: Dict[Path, str] = {}
+    for rel_path, stat in stats.items():
+        size, mtime_ns, cached_hash = cached.get(rel_path.as_posix(), (None, None, None))
+        if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+            hashes[rel_path] = cached_hash
+
+    # hashlib releases the GIL while it chews on each chunk, so threads are enough to saturate the disk
+    to_hash = [rel_path for rel_path in stats if rel_path not in hashes]
+    with ThreadPoolExecutor(hash_threads) as pool:
+        hashes.update(zip(to_hash, pool.map(lambda rel_path: md5_hash(component_root / rel_path), to_hash)))
+    logging.info(f'Hashed {len(to_hash)} files; reused hashes for the other {len(stats) - len(to_hash)}')
+
+    entries: DefaultDict[Path, List[ManifestEntry]] = defaultdict(list)
+    zips: Dict[Path, str] = {}
+    for rel_path in sorted(stats):
+        in_zip = next((Path(zip_path) for pattern, zip_path in zip_rules if fnmatch.fnmatchcase(rel_path.as_posix(), pattern)), None)
+        entries[rel_path].append(ManifestEntry(hash=hashes[rel_path], in_zip=in_zip))
+        if in_zip and in_zip not in zips:
+            assert zip_archive_hash, f'{rel_path} goes in the ZIP {in_zip}, so you need to give us zip_archive_hash'
+            zips[in_zip] = zip_archive_hash(in_zip)
+
+    history = dict(previous.history) if previous else {}
+    previous_hashes = {path: locations[0].hash for path, locations in previous.entries.items()} if previous else {}
+    for path in set(previous_hashes) | set(hashes):
+        if previous_hashes.get(path) != hashes.get(path):
+            history[path] = ManifestHistory(version)
+
+    if stat_cache_path:
+        stat_cache_path.write_text(json.dumps({rel_path.as_posix(): [stat.st_size, stat.st_mtime_ns, hashes[rel_path]]
+                                               for rel_path, stat in stats.items()}))
+    return ComponentManifest(version, Path(install_path_prefix), entries, history, zips)
+
+
+def component_file_url(component: ComponentBlock, path: Pathlike, base_url: Optional[str]=None) -> str:
+    """Where a RAWFILE or ZIP from the component's manifest lives. @param base_url as in component_manifest_url()"""
+    return f'{base_url or component.cdn_subdomain.base_url}{component.package_path}/{Path(path).as_posix()}'
+
+
+class ContentStore:
+    """
+    Downloaded files, stored once per hash (as root/ab/abcdef...), no matter how many components or paths share them.
+    Only files whose hash has been verified are ever moved into the store; in-progress downloads live in root/partial.
+    """
+    def __init__(self, root: Path):
+        self.root = root
+        self.partial_dir = root / 'partial'
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, md5: str) -> Path: return self.root / md5[:2] / md5
+    def partial_path_for(self, md5: str) -> Path: return self.partial_dir / f'{md5}.part'
+    def __contains__(self, md5: str) -> bool: return self.path_for(md5).is_file()
+
+    @contextmanager
+    def locked(self, md5: str):
+        """
+        Holds an exclusive lock on this hash, so that downloads sharing the store (even from other processes)
+        take turns rather than interleaving their writes to the same partial file. The OS releases the lock
+        if we die holding it, so there are no stale locks to clean up.
+        """
+        lock_path = self.partial_dir / f'{md5}.lock'
+        with lock_path.open('a+b') as lock_file:
+            _lock_exclusively(lock_file)
+            yield
+        if md5 in self:  # anyone still waiting on this lock will find the file in the store once they get it
+            with suppress(OSError):  # whoever held it before us may have beaten us to it (or, on Windows, someone still has it open)
+                lock_path.unlink()
+
+    def add(self, verified_file: Path, md5: str, move: bool=False) -> Path:
+        """Stores the file, copying unless asked to move it (so nothing outside the store can later change what's in it)"""
+        stored = self.path_for(md5)
+        stored.parent.mkdir(exist_ok=True)
+        if move:
+            os.replace(verified_file, stored)
+        else:
+            _copy_atomically(verified_file, stored, self.partial_dir)
+        return stored
+
+    def check_out(self, md5: str, dest: Path):
+        """
+        Copies the stored file to dest. It's a copy rather than a hard link because the store trusts whatever
+        it holds: a link would let anyone editing dest silently corrupt the store for every later checkout.
+        """
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        _copy_atomically(self.path_for(md5), dest, dest.parent)
+
+
+def _lock_exclusively(lock_file: BinaryIO):
+    """Blocks until we hold an exclusive lock on the file, which is released when the file is closed"""
+    if platform.system() == 'Windows':
+        import msvcrt
+        lock_file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:  # LK_LOCK gives up after 10 seconds of trying; we'll wait as long as it takes
+                continue
+    else:
+        import fcntl
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+
+def _copy_atomically(source: Path, dest: Path, tmp_parent: Path):
+    """Copies via a temp dir in tmp_parent (on dest's file system), so a half-copied file never appears at dest"""
+    with tempfile.TemporaryDirectory(dir=tmp_parent) as tmp_dir:
+        shutil.copyfile(source, Path(tmp_dir) / dest.name)
+        os.replace(Path(tmp_dir) / dest.name, dest)
+
+
+DownloadResult = namedtuple('DownloadResult', ['md5', 'url', 'status', 'error'])  # status is 'present', 'downloaded', 'resumed' or 'failed' (in which case error has the traceback)
+
+def _download_to_store(session, url: str, md5: str, store: ContentStore, already_on_disk: Iterable[Path],
+                       retries: int, chunk_size_bytes: int, timeout: HttpTimeout) -> DownloadResult:
+    try:
+        with store.locked(md5):
+            if md5 in store:  # someone else sharing the store got it while we waited for the lock
+                return DownloadResult(md5, url, 'present', None)
+            for candidate in already_on_disk:
+                if candidate.is_file() and md5_hash(candidate) == md5:
+                    store.add(candidate, md5)
+                    return DownloadResult(md5, url, 'present', None)
+            return _fetch_into_store(session, url, md5, store, retries, chunk_size_bytes, timeout)
+    except Exception:
+        return DownloadResult(md5, url, 'failed', traceback.format_exc())
+
+
+def _fetch_into_store(session, url: str, md5: str, store: ContentStore, retries: int, chunk_size_bytes: int, timeout: HttpTimeout) -> DownloadResult:
+    """Only call this while holding store.locked(md5)"""
+    import requests
+
+    partial = store.partial_path_for(md5)
+    resumed = False
+    for attempt in range(retries + 1):
+        offset = partial.stat().st_size if partial.is_file() else 0
+        hasher = hashlib.md5()
+        try:
+            with session.get(url, stream=True, headers={'Range': f'bytes={offset}-'} if offset else {}, timeout=timeout) as response:
+                if response.status_code == 416:  # our partial file is at least as big as the real thing, so it's junk
+                    partial.unlink()
+                    continue
+                response.raise_for_status()
+                if response.status_code == 206:
+                    assert response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'), f'Server sent the wrong range for {url}'
+                    resumed = True
+                    with partial.open('rb') as f:  # pick the hash up where we left off
+                        for chunk in iter(lambda: f.read(chunk_size_bytes), b''):
+                            hasher.update(chunk)
+                with partial.open('ab' if response.status_code == 206 else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size_bytes):
+                        hasher.update(chunk)
+                        f.write(chunk)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+            logging.warning(f'Download of {url} was interrupted; resuming (attempt {attempt + 2} of {retries + 1})')
+            continue
+
+        if hasher.hexdigest() == md5:
+            store.add(partial, md5, move=True)
+            return DownloadResult(md5, url, 'resumed' if resumed else 'downloaded', None)
+        partial.unlink()  # the server's file (or whatever we resumed from) was bad; start over
+        logging.warning(f'Hash mismatch for {url}: expected {md5}, got {hasher.hexdigest()}')
+    raise RuntimeError(f'Failed to download {url} with hash {md5} after {retries + 1} attempts')
+
+
+def download_components(manifests: Iterable[Tuple[ComponentBlock, ComponentManifest]], store: ContentStore,
+                        mirror_dir: Optional[Path]=None,
+                        file_url_for: Callable[[ComponentBlock, Path], str]=component_file_url,
+                        max_connections: int=16,
+                        retries: int=3,
+                        chunk_size_bytes: int=64 * 1024,
+                        timeout: HttpTimeout=(10, 60)) -> List[DownloadResult]:
+    """
+    Downloads every RAWFILE and ZIP in the manifests into the content store, up to max_connections at a time.
+    Each file is hashed as it streams to disk, and only lands in the store if it matches its manifest hash.
+    Files already in the store (or already at their path in the mirror, with the right hash) aren't downloaded again,
+    and a file shared by any number of components is fetched once. An interrupted download resumes from where
+    it left off (via an HTTP Range request), both within this call and the next time you call it.
+
+    @param timeout (connect, read) seconds: a server that goes quiet for longer than the read timeout counts as an
+                   interrupted download, which we resume like any other
+    @param mirror_dir If given, we check every file out to mirror_dir/<package path>/<path in manifest>, the same layout
+                      as the CDN's files. We don't write the manifests themselves there, so to serve the mirror as a
+                      base_url, you'll need to add each <package path>/<version>/directory.txt yourself.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    urls: Dict[str, str] = {}  # md5 -> URL to get it from (any one will do)
+    destinations: DefaultDict[str, List[Path]] = defaultdict(list)  # md5 -> mirror paths
+    for component, manifest in manifests:
+        rawfiles = ((path, entry.hash) for path, entry in manifest.all_paths_all_entries() if not entry.in_zip)
+        for path, md5 in itertools.chain(rawfiles, manifest.zips.items()):
+            if md5 not in urls:
+                urls[md5] = _signed_if_required(component, file_url_for(component, path))
+            if mirror_dir:
+                destinations[md5].append(mirror_dir / component.package_path.lstrip('/') / path)
 
+    results = [DownloadResult(md5, url, 'present', None) for md5, url in urls.items() if md5 in store]
+    to_download = [md5 for md5 in urls if md5 not in store]
+    with pooled_session(max_connections) as session:
+        with ThreadPoolExecutor(max_connections) as pool:
+            results += pool.map(lambda md5: _download_to_store(session, urls[md5], md5, store, destinations[md5], retries, chunk_size_bytes, timeout),
+                                to_download)
 
+    for result in results:
+        if result.status == 'failed':
+            logging.error(f'Failed to download {result.url}:\n{result.error}')
+        else:
+            for dest in destinations[result.md5]:
+                store.check_out(result.md5, dest)
+    logging.info(f'Downloaded {sum(r.status in ("downloaded", "resumed") for r in results)} files '
+                 f'({sum(r.status == "failed" for r in results)} failed); {sum(r.status == "present" for r in results)} were already present')
+    return results
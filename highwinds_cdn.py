@@ -1,27 +1,26 @@
 #!/usr/bin/env python3
+import functools
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
 from getpass import getpass
-from pathlib import Path
-from time import sleep
-from typing import Iterable, Union, List, Collection
+from pathlib import Path, PurePosixPath
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Iterable, Union, List, Collection, Optional, Dict
 from urllib.parse import urlparse
 
-import requests  # TODO: Remove dependency for downstream clients
 from utils.files import md5_hash, Pathlike
 
-global cdn_token
-try:
-    cdn_token = os.environ['HIGHWINDS_TOKEN']
-except KeyError:
-    cdn_token = None  # we'll generate a temporary token via username & password on our first interaction with the CDN
+if TYPE_CHECKING:
+    import asyncio
+    import requests
 
-global cdn_signing_secret
-try:
-    cdn_signing_secret = os.environ['HIGHWINDS_SIGNING_SECRET']
-except KeyError:
-    cdn_signing_secret = None  # we'll ask during our first signing attempt
+# requests is only imported once you create a StrikeTrackerClient (or any other pooled_session()), so that clients who only need CdnServer
+# (like glomo's parsing) don't pay for it. Likewise, we only look for our secrets in the environment when we need them.
+cdn_token: Optional[str] = None  # $HIGHWINDS_TOKEN, else we'll generate a temporary token via username & password on our first interaction with the CDN
+cdn_signing_secret: Optional[str] = None  # $HIGHWINDS_SIGNING_SECRET, else we'll ask during our first signing attempt
 
 
 class CdnServer(Enum):
@@ -40,30 +39,49 @@ class CdnServer(Enum):
         return CdnServer.MobileSecure if server_id == 'SERVER_SECURE' else CdnServer.MobileUnsecured
 
 
+def pooled_session(max_connections: int) -> 'requests.Session':
+    """A Session that keeps up to max_connections connections per host alive, for sharing across that many threads"""
+    import requests
+    session = requests.Session()
+    connection_pool = requests.adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount('http://', connection_pool)
+    session.mount('https://', connection_pool)
+    return session
+
+
 class StrikeTrackerClient:
-    """Copied with minor modifications from the no-longer-maintained official client: https://github.com/Highwinds/striketracker"""
-    def __init__(self, base_url='https://striketracker.highwinds.com', account_hash='c7c3x3s9', token=None):
+    """
+    Copied with minor modifications from the no-longer-maintained official client: https://github.com/Highwinds/striketracker
+    All requests go through one pooled keep-alive Session, so we only pay for the TLS handshake once per connection.
+    """
+    def __init__(self, base_url='https://striketracker.highwinds.com', account_hash='c7c3x3s9', token=None, max_connections: int=8):
         self.base_url = base_url
         self.token = token
         self.account_hash = account_hash
+        self.max_connections = max_connections
+        self.session = pooled_session(max_connections)
+
+    @staticmethod
+    def _checked_json(response: 'requests.Response', required_key: str, error_message: str) -> dict:
+        body = response.json()
+        if required_key not in body:
+            raise RuntimeError(error_message, response)
+        return body
 
     def create_token(self, username, password, application=None):
         if application is None:
             application = 'StrikeTracker Python client'
 
         # Grab an access token to use to fetch user
-        response = requests.post(self.base_url + '/auth/token', data={
+        auth = self._checked_json(self.session.post(self.base_url + '/auth/token', data={
             "username": username, "password": password, "grant_type": "password"
         }, headers={
             'User-Agent': application
-        })
-        auth = response.json()
-        if 'access_token' not in auth:
-            raise RuntimeError('Could not fetch access token', response)
+        }), 'access_token', 'Could not fetch access token')
         access_token = auth['access_token']
 
         # Grab user's id and root account hash
-        user_response = requests.get(self.base_url + '/api/v1/users/me', headers={'Authorization': 'Bearer %s' % access_token})
+        user_response = self.session.get(self.base_url + '/api/v1/users/me', headers={'Authorization': 'Bearer %s' % access_token})
         user = user_response.json()
         if 'accountHash' not in user or 'id' not in user:
             raise RuntimeError('Could not fetch user\'s root account hash', user_response)
@@ -71,7 +89,7 @@ class StrikeTrackerClient:
         user_id = user['id']
 
         # Generate a new API token
-        token_response = requests.post(self.base_url + ('/api/v1/accounts/{account_hash}/users/{user_id}/tokens'.format(
+        token_response = self.session.post(self.base_url + ('/api/v1/accounts/{account_hash}/users/{user_id}/tokens'.format(
             account_hash=self.account_hash, user_id=user_id
         )), json={
             "password": password, "application": application
@@ -79,31 +97,100 @@ class StrikeTrackerClient:
             'Authorization': 'Bearer %s' % access_token,
             'Content-Type': 'application/json'
         })
-        if 'token' not in token_response.json():
-            raise RuntimeError('Could not generate API token', token_response)
-        self.token = token_response.json()['token']
+        self.token = self._checked_json(token_response, 'token', 'Could not generate API token')['token']
         return self.token
 
     def purge(self, urls, recursive=True):
-        purge_response = requests.post(f'{self.base_url}/api/v1/accounts/{self.account_hash}/purge', json={
+        purge_response = self.session.post(f'{self.base_url}/api/v1/accounts/{self.account_hash}/purge', json={
             "list": [{"url": url, "recursive":  recursive}
                      for url in urls]
         }, headers={
             'Content-Type': 'application/json',
             'Authorization': 'Bearer %s' % self.token
         })
-        if 'id' not in purge_response.json():
-            raise RuntimeError('Could not send purge batch', purge_response)
-        return purge_response.json()['id']
+        return self._checked_json(purge_response, 'id', 'Could not send purge batch')['id']
+
+    def purge_batched(self, urls: Collection[str], recursive=True, batch_size: int=500) -> List[str]:
+        """Splits a huge URL list into batches, submitted concurrently. @return the purge job ID for each batch"""
+        urls = list(urls)
+        batches = [urls[start:start + batch_size] for start in range(0, len(urls), batch_size)]
+        with ThreadPoolExecutor(self.max_connections) as pool:
+            return list(pool.map(lambda batch: self.purge(batch, recursive), batches))
 
     def purge_status_ratio(self, job_id) -> float:
         """Returns the progress as a ratio of the total items to be purged (in the range 0 to 1)"""
-        status_response = requests.get(f'{self.base_url}/api/v1/accounts/{self.account_hash}/purge/{job_id}', headers={
+        status_response = self.session.get(f'{self.base_url}/api/v1/accounts/{self.account_hash}/purge/{job_id}', headers={
             'Authorization': 'Bearer %s' % self.token,
             })
-        if 'progress' not in status_response.json():
-            raise RuntimeError('Could not fetch purge status', status_response)
-        return float(status_response.json()['progress'])
+        return float(self._checked_json(status_response, 'progress', 'Could not fetch purge status')['progress'])
+
+    def await_purges(self, job_ids: Iterable[str], timeout_seconds: float, first_poll_seconds: float=0.25, max_poll_seconds: float=8):
+        """
+        Polls all outstanding purge jobs together until they're done, backing off (up to max_poll_seconds)
+        for as long as they stay outstanding.
+        """
+        outstanding = list(job_ids)
+        start = monotonic()
+        poll_seconds = first_poll_seconds
+        with ThreadPoolExecutor(self.max_connections) as pool:
+            while outstanding:
+                ratios = list(pool.map(self.purge_status_ratio, outstanding))
+                outstanding = [job_id for job_id, ratio in zip(outstanding, ratios) if ratio < 0.99]
+                waited = monotonic() - start
+                if not outstanding:
+                    break
+                elif waited > timeout_seconds:
+                    raise TimeoutError(f'CDN cache flushed timed out after {waited:.0f} seconds')
+                logging.info(f'Waiting for {len(outstanding)} purge jobs to complete (least complete is at {min(ratios) * 100}%, after {waited:.0f} seconds waiting)')
+                sleep(poll_seconds)
+                poll_seconds = min(2 * poll_seconds, max_poll_seconds)
+
+
+class AsyncStrikeTrackerClient:
+    """
+    An async/await flavor of StrikeTrackerClient, for callers already running an event loop.
+    Requests run on the loop's executor against the wrapped client's pooled Session, with no more in flight at once
+    than the pool has connections (beyond that, urllib3 would open extra connections only to throw them away).
+    """
+    def __init__(self, client: Optional[StrikeTrackerClient]=None, **client_kwargs):
+        self.client = client or StrikeTrackerClient(**client_kwargs)
+        self._in_flight: Optional['asyncio.Semaphore'] = None  # created on first use, so it belongs to the running loop
+
+    async def _run(self, fn, *args):
+        import asyncio
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.client.max_connections)
+        async with self._in_flight:
+            return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    async def create_token(self, username, password, application=None) -> str:
+        return await self._run(self.client.create_token, username, password, application)
+
+    async def purge(self, urls, recursive=True) -> str:
+        return await self._run(self.client.purge, urls, recursive)
+
+    async def purge_batched(self, urls: Collection[str], recursive=True, batch_size: int=500) -> List[str]:
+        import asyncio
+        urls = list(urls)
+        return list(await asyncio.gather(*(self.purge(urls[start:start + batch_size], recursive)
+                                           for start in range(0, len(urls), batch_size))))
+
+    async def purge_status_ratio(self, job_id) -> float:
+        return await self._run(self.client.purge_status_ratio, job_id)
+
+    async def await_purges(self, job_ids: Iterable[str], timeout_seconds: float, first_poll_seconds: float=0.25, max_poll_seconds: float=8):
+        import asyncio
+        outstanding = list(job_ids)
+        start = monotonic()
+        poll_seconds = first_poll_seconds
+        while outstanding:
+            ratios = await asyncio.gather(*map(self.purge_status_ratio, outstanding))
+            outstanding = [job_id for job_id, ratio in zip(outstanding, ratios) if ratio < 0.99]
+            if outstanding and monotonic() - start > timeout_seconds:
+                raise TimeoutError(f'CDN cache flushed timed out after {monotonic() - start:.0f} seconds')
+            elif outstanding:
+                await asyncio.sleep(poll_seconds)
+                poll_seconds = min(2 * poll_seconds, max_poll_seconds)
 
 
 def mobile_abs_server_path(secured_or_unsecured: CdnServer, rel_path: Pathlike=Path('')) -> Path:
@@ -111,8 +198,70 @@ def mobile_abs_server_path(secured_or_unsecured: CdnServer, rel_path: Pathlike=P
     return (Path('/var/www/cdn-root/content') / subdir) / rel_path
 
 
-def flush_cdn_cache(server: CdnServer, mobile_abs_paths: Union[Pathlike, Collection[Pathlike]]='/', recursive: bool=True, await_confirmation: bool=False):
+@dataclass
+class PurgePlan:
+    paths: List[PurePosixPath]  # what to actually purge (recursively)
+    requested: int  # how many paths we were asked to purge
+
+    @property
+    def reduction(self) -> float:
+        """The fraction of the requested purge paths we got rid of"""
+        return 1 - len(self.paths) / self.requested if self.requested else 0
+
+    def __str__(self):
+        return f'Purging {len(self.paths)} paths in place of the {self.requested} requested ({self.reduction * 100:.0f}% fewer)'
+
+
+def plan_purge(mobile_abs_paths: Iterable[Pathlike], collapse_threshold: Optional[int]=32, min_collapse_depth: int=7) -> PurgePlan:
+    """
+    Minimizes the set of paths for a *recursive* purge: drops duplicates and paths already covered by a parent,
+    then replaces any directory's worth of purges with a single purge of the directory itself once there are at
+    least collapse_threshold of them (over-purging a few files is much cheaper than thousands of purge entries).
+    A collapse_threshold of None never purges anything you didn't ask for.
+
+    @param min_collapse_depth We'll never collapse into a directory with fewer path components than this;
+                              the default keeps us within the mobile_(un)secured directories of mobile_abs_server_path()
+
+    >>> root = '/var/www/cdn-root/content/mobile_secured'
+    >>> plan = plan_purge([f'{root}/a/{i}.dsf' for i in range(3)] + [f'{root}/a/0.dsf', f'{root}/b', f'{root}/b/c.png'], collapse_threshold=3)
+    >>> [str(p) for p in plan.paths]
+    ['/var/www/cdn-root/content/mobile_secured/a', '/var/www/cdn-root/content/mobile_secured/b']
+    >>> print(plan)
+    Purging 2 paths in place of the 6 requested (67% fewer)
+    >>> len(plan_purge([f'{root}/a/{i}.dsf' for i in range(3)], collapse_threshold=None).paths)
+    3
+    """
+    purged = object()  # marks a trie node we're going to purge (along with everything beneath it)
+    trie: Dict = {}
+    requested = 0
+    for path in mobile_abs_paths:
+        requested += 1
+        node = trie
+        for part in PurePosixPath(path).parts:
+            if purged in node:  # a parent is already getting purged
+                break
+            node = node.setdefault(part, {})
+        else:
+            node.clear()
+            node[purged] = True
+
+    def collapse(node: Dict, parts: List[str]) -> List[PurePosixPath]:
+        if purged in node:
+            return [PurePosixPath(*parts)]
+        below = [path
+                 for part, child in node.items()
+                 for path in collapse(child, parts + [part])]
+        should_collapse = collapse_threshold is not None and len(parts) >= min_collapse_depth and len(below) >= collapse_threshold
+        return [PurePosixPath(*parts)] if should_collapse else below
+
+    return PurgePlan(sorted(collapse(trie, [])), requested)
+
+
+def flush_cdn_cache(server: CdnServer, mobile_abs_paths: Union[Pathlike, Collection[Pathlike]]='/', recursive: bool=True, await_confirmation: bool=False,
+                    collapse_threshold: Optional[int]=None):
+    """@param collapse_threshold For recursive purges, see plan_purge(). None (the default) purges exactly the paths you give us."""
     global cdn_token
+    cdn_token = cdn_token or os.environ.get('HIGHWINDS_TOKEN')
     client = StrikeTrackerClient(token=cdn_token)
     if not client.token:  # we'll need to generate a temporary token
         cdn_token = client.create_token('austin@x-plane.com', getpass('Highwinds Password: ').strip(), 'mobile.x-plane.com')
@@ -121,24 +270,23 @@ def flush_cdn_cache(server: CdnServer, mobile_abs_paths: Union[Pathlike, Collect
         mobile_abs_paths = [mobile_abs_paths]
 
     assert all(str(path).startswith('/') for path in mobile_abs_paths), 'CDN path was not absolute'
+    requested = len(mobile_abs_paths)
+    if recursive:
+        plan = plan_purge(mobile_abs_paths, collapse_threshold)
+        logging.info(plan)
+        mobile_abs_paths = plan.paths
     urls = [server.base_url + str(path)
             for path in mobile_abs_paths]
-    purge_job_id = client.purge(urls, recursive)
-    waited = 0
-    ratio_complete = 0
-    while await_confirmation and ratio_complete < 0.99:
-        ratio_complete = client.purge_status_ratio(purge_job_id)
-        sleep(1)
-        waited += 1
-        if waited > 30 + len(mobile_abs_paths):
-            raise TimeoutError(f'CDN cache flushed timed out after {waited} seconds')
-        elif waited % 10 == 0:
-            logging.info(f'Waiting for purge to complete (currently at {ratio_complete * 100}%, after {waited} seconds waiting)')
-    logging.info(f'Purge completed after {waited} seconds')
+    start = monotonic()
+    purge_job_ids = client.purge_batched(urls, recursive)
+    if await_confirmation:
+        client.await_purges(purge_job_ids, timeout_seconds=30 + requested)
+    logging.info(f'Purge completed after {monotonic() - start:.0f} seconds')
 
 
 def sign_secured_url(original_url: str):
     global cdn_signing_secret
+    cdn_signing_secret = cdn_signing_secret or os.environ.get('HIGHWINDS_SIGNING_SECRET')
     if not cdn_signing_secret:
         cdn_signing_secret = getpass('Highwinds Signing Secret: ').strip()
     to_hash = f'{urlparse(original_url).path}?secret={cdn_signing_secret}'
@@ -0,0 +1,39 @@
+"""
+Keeps an eye on how expensive it is to import our modules. Most scripts only need a little of what a module offers,
+so heavy dependencies (requests, NumPy, multiprocessing, etc.) should only be imported by the functions that use them.
+
+>>> cost = import_cost(['utils.files', 'utils.data_processing', 'utils.glomo', 'utils.highwinds_cdn', 'utils.dsf', 'utils.dsf_binary', 'utils.git'])
+>>> cost.heavy_modules
+[]
+>>> cost.seconds < 1  # typically ~0.05 seconds; this is just a generous bound to catch something heavy sneaking back in
+True
+"""
+import sys
+from collections import namedtuple
+from pathlib import Path
+from typing import Iterable
+
+from utils.data_processing import checked_subprocess
+
+ImportCost = namedtuple('ImportCost', ['seconds', 'heavy_modules'])  # heavy_modules are those of HEAVY_MODULES that got imported
+
+HEAVY_MODULES = ('asyncio', 'concurrent.futures.process', 'multiprocessing', 'numpy', 'requests', 'shapefile', 'ssl', 'urllib.request', 'urllib3')
+
+
+def import_cost(module_names: Iterable[str]) -> ImportCost:
+    """
+    Imports the modules in a fresh interpreter, timing just the imports (not the interpreter's startup).
+    The interpreter loads this directory as the utils package, whatever your checkout happens to be called.
+    """
+    script = '\n'.join([
+        'import sys, time, types',
+        "package = types.ModuleType('utils')",
+        f'package.__path__ = [{str(Path(__file__).resolve().parent)!r}]',
+        "sys.modules['utils'] = package",
+        'start = time.perf_counter()',
+        f'for name in {list(module_names)!r}: __import__(name)',
+        'print(time.perf_counter() - start)',
+        f'print(*[module for module in {HEAVY_MODULES!r} if module in sys.modules])',
+    ])
+    seconds, heavy_modules = checked_subprocess([sys.executable, '-c', script]).stdout.splitlines()
+    return ImportCost(float(seconds), heavy_modules.split())
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Vectorized loading of shapefile (.shp) geometry into NumPy arrays, and bucketing it into 1x1 degree DSF tiles.
+
+Unlike dsf.Shapefile (which hands you shapes one at a time, as lists of Python point tuples), this reads the
+.shp directly, in chunks, into flat arrays of coordinates plus offsets---there's no Python object per point.
+We only read X/Y (lon/lat); any Z or M values are skipped.
+"""
+import struct
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import DefaultDict, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from utils.dsf import LatLon
+
+# Shape types, ignoring the Z/M variants (13 is a PolyLineZ, 25 a PolygonM, etc.)
+NULL_SHAPE, POINT, POLYLINE, POLYGON, MULTIPOINT = 0, 1, 3, 5, 8
+MULTIPATCH = 31  # 3D surfaces, which we don't support (and which aren't a variant of POINT, despite 31 % 10 == 1)
+
+_shp_file_code = 9994
+_shp_header_size = 100
+_record_header = struct.Struct('>ii')  # record number, content length in 16-bit words
+_part_counts = struct.Struct('<ii')  # number of parts, number of points (after the shape type & bbox)
+
+ShapeParts = Tuple[int, List[np.ndarray]]  # a record ID plus the (N, 2) point array of each of its parts
+
+
+def _base_type(shape_type: int) -> int:
+    return shape_type if shape_type == MULTIPATCH else shape_type % 10
+
+
+def _ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenation of range(start, start + count) for each pair, without a Python loop"""
+    counts = np.asarray(counts, dtype=np.int64)
+    total = counts.sum()
+    if not total:
+        return np.empty(0, dtype=np.int64)
+    run_starts = np.cumsum(counts) - counts
+    return np.repeat(np.asarray(starts, dtype=np.int64) - run_starts, counts) + np.arange(total)
+
+
+@dataclass
+class ShapeArrays:
+    """
+    Many shapes' geometry in flat arrays: shape i's parts are part indices shape_offsets[i] to shape_offsets[i + 1],
+    and part j's points are points[part_offsets[j]:part_offsets[j + 1]]
+    """
+    shape_type: int
+    record_ids: np.ndarray  # (shapes,) the index in the .shp of the record each shape came from
+    shape_offsets: np.ndarray  # (shapes + 1,)
+    part_offsets: np.ndarray  # (parts + 1,)
+    points: np.ndarray  # (points, 2) of lon, lat
+
+    def __len__(self): return len(self.record_ids)
+
+    @property
+    def base_type(self) -> int: return _base_type(self.shape_type)
+
+    @staticmethod
+    def from_shapes(shape_type: int, shapes: Iterable[ShapeParts]) -> 'ShapeArrays':
+        record_ids, part_counts, parts = [], [], []
+        for record_id, shape_parts in shapes:
+            record_ids.append(record_id)
+            part_counts.append(len(shape_parts))
+            parts += shape_parts
+        return ShapeArrays(shape_type,
+                           np.array(record_ids, dtype=np.int64),
+                           np.concatenate([[0], np.cumsum(part_counts, dtype=np.int64)]),
+                           np.concatenate([[0], np.cumsum([len(part) for part in parts], dtype=np.int64)]),
+                           np.concatenate(parts) if parts else np.empty((0, 2)))
+
+    @staticmethod
+    def concatenate(arrays: List['ShapeArrays']) -> 'ShapeArrays':
+        assert arrays and all(a.shape_type == arrays[0].shape_type for a in arrays)
+        shape_offsets, part_offsets = [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)]
+        for a in arrays:
+            shape_offsets.append(a.shape_offsets[1:] + shape_offsets[-1][-1])
+            part_offsets.append(a.part_offsets[1:] + part_offsets[-1][-1])
+        return ShapeArrays(arrays[0].shape_type,
+                           np.concatenate([a.record_ids for a in arrays]),
+                           np.concatenate(shape_offsets),
+                           np.concatenate(part_offsets),
+                           np.concatenate([a.points for a in arrays]))
+
+    def shape_parts(self, shape_idx: int) -> List[np.ndarray]:
+        part_offsets = self.part_offsets[self.shape_offsets[shape_idx]:self.shape_offsets[shape_idx + 1] + 1]
+        return [self.points[start:end] for start, end in zip(part_offsets[:-1], part_offsets[1:])]
+
+    def take(self, shape_indices: np.ndarray) -> 'ShapeArrays':
+        """The subset of shapes at these indices, gathered without a Python loop"""
+        part_counts = np.diff(self.shape_offsets)[shape_indices]
+        part_indices = _ranges(self.shape_offsets[shape_indices], part_counts)
+        point_counts = np.diff(self.part_offsets)[part_indices]
+        return ShapeArrays(self.shape_type,
+                           self.record_ids[shape_indices],
+                           np.concatenate([[0], np.cumsum(part_counts)]),
+                           np.concatenate([[0], np.cumsum(point_counts)]),
+                           self.points[_ranges(self.part_offsets[part_indices], point_counts)])
+
+    def bboxes(self) -> np.ndarray:
+        """(shapes, 4) array of west, south, east, north---the same order as dsf_tile_bbox()"""
+        if not len(self):
+            return np.empty((0, 4))
+        first_points = self.part_offsets[self.shape_offsets[:-1]]
+        mins = np.minimum.reduceat(self.points, first_points)
+        maxes = np.maximum.reduceat(self.points, first_points)
+        return np.hstack([mins, maxes])
+
+
+def _parse_records(buffer: memoryview, first_record_id: int) -> Tuple[List[ShapeParts], int, int]:
+    """
+    @return The shapes from all complete records in the buffer, the number of bytes consumed, and the number of records read
+            (a record cut off by the end of the buffer is left for the next chunk)
+
+    >>> def polyline_record(*parts):
+    ...     points = np.concatenate(parts)
+    ...     content = (struct.pack('<i4d2i', POLYLINE, 0, 0, 0, 0, len(parts), len(points)) +
+    ...                np.cumsum([0] + [len(part) for part in parts[:-1]]).astype('<i4').tobytes() + points.astype('<f8').tobytes())
+    ...     return _record_header.pack(0, len(content) // 2) + content
+    >>> records = polyline_record(np.array([[0, 0], [1, 1]])) + polyline_record(np.array([[2, 2], [3, 3]]), np.array([[4, 4], [5, 5]]))
+    >>> shapes, consumed, num_records = _parse_records(memoryview(records[:-8]), first_record_id=10)
+    >>> [(record_id, [part.tolist() for part in parts]) for record_id, parts in shapes], consumed, num_records
+    ([(10, [[[0.0, 0.0], [1.0, 1.0]]])], 88, 1)
+    >>> shapes, consumed, num_records = _parse_records(memoryview(records[consumed:]), first_record_id=11)
+    >>> [(record_id, [part.tolist() for part in parts]) for record_id, parts in shapes], consumed, num_records
+    ([(11, [[[2.0, 2.0], [3.0, 3.0]], [[4.0, 4.0], [5.0, 5.0]]])], 124, 1)
+    """
+    shapes = []
+    pos = 0
+    record_id = first_record_id
+    while pos + _record_header.size <= len(buffer):
+        _record_number, content_words = _record_header.unpack_from(buffer, pos)
+        content = pos + _record_header.size
+        if content + 2 * content_words > len(buffer):
+            break
+        shape_type = _base_type(struct.unpack_from('<i', buffer, content)[0])
+        if shape_type == POINT:
+            shapes.append((record_id, [np.frombuffer(buffer, dtype='<f8', count=2, offset=content + 4).reshape(1, 2)]))
+        elif shape_type in (POLYLINE, POLYGON):
+            num_parts, num_points = _part_counts.unpack_from(buffer, content + 36)
+            part_starts = np.frombuffer(buffer, dtype='<i4', count=num_parts, offset=content + 44)
+            points = np.frombuffer(buffer, dtype='<f8', count=2 * num_points, offset=content + 44 + 4 * num_parts).reshape(-1, 2)
+            if num_points:
+                shapes.append((record_id, np.split(points, part_starts[1:])))
+        elif shape_type == MULTIPOINT:
+            num_points = struct.unpack_from('<i', buffer, content + 36)[0]
+            if num_points:
+                shapes.append((record_id, [np.frombuffer(buffer, dtype='<f8', count=2 * num_points, offset=content + 40).reshape(-1, 2)]))
+        pos = content + 2 * content_words
+        record_id += 1
+    return shapes, pos, record_id - first_record_id
+
+
+def _parse_point_records(buffer: memoryview, shape_type: int, first_record_id: int) -> Tuple[Optional[ShapeArrays], int, int]:
+    """
+    Fast path for point files: when all the records in the buffer are the same size, we read them as one structured array.
+    @return as _parse_records(), or None for the ShapeArrays if the records aren't uniform (e.g., there are null shapes)
+    """
+    content_words = _record_header.unpack_from(buffer, 0)[1]
+    zm_bytes = 2 * content_words - 20  # PointZ & PointM records have these trailing values, which we skip
+    if zm_bytes < 0:  # a null shape
+        return None, 0, 0
+    record = np.dtype([('number', '>i4'), ('content_words', '>i4'), ('shape_type', '<i4'), ('xy', '<f8', 2)] +
+                      ([('zm', 'V%d' % zm_bytes)] if zm_bytes else []))
+    count = len(buffer) // record.itemsize
+    records = np.frombuffer(buffer, dtype=record, count=count)
+    if not ((records['content_words'] == content_words) & (records['shape_type'] == shape_type)).all():
+        return None, 0, 0
+    return ShapeArrays(shape_type,
+                       np.arange(first_record_id, first_record_id + count),
+                       np.arange(count + 1),
+                       np.arange(count + 1),
+                       records['xy'].copy()), count * record.itemsize, count
+
+
+def iter_shape_chunks(shp_path: Path, chunk_bytes: int=64 * 1024 * 1024) -> Iterator[ShapeArrays]:
+    """Streams the geometry of the shapefile, roughly chunk_bytes of it at a time, so huge files don't need to fit in memory"""
+    with shp_path.open('rb') as shp:
+        header = shp.read(_shp_header_size)
+        assert struct.unpack_from('>i', header, 0)[0] == _shp_file_code, f'{shp_path} is not a shapefile'
+        shape_type = struct.unpack_from('<i', header, 32)[0]
+        if shape_type == MULTIPATCH:
+            raise RuntimeError(f'{shp_path} is a MultiPatch shapefile, which we can\'t read')
+
+        leftover = b''
+        record_id = 0
+        while True:
+            chunk = shp.read(chunk_bytes)
+            buffer = memoryview(leftover + chunk)
+            if not buffer:
+                return
+            arrays = None
+            if _base_type(shape_type) == POINT and len(buffer) >= _record_header.size:
+                arrays, consumed, num_records = _parse_point_records(buffer, shape_type, record_id)
+            if arrays is None:
+                shapes, consumed, num_records = _parse_records(buffer, record_id)
+                arrays = ShapeArrays.from_shapes(shape_type, shapes)
+            if not chunk and not num_records:
+                raise RuntimeError(f'Truncated record at the end of {shp_path}')
+            record_id += num_records
+            leftover = bytes(buffer[consumed:])
+            if len(arrays):
+                yield arrays
+
+
+def load_shapes(shp_path: Path) -> ShapeArrays:
+    """The whole shapefile's geometry at once"""
+    chunks = list(iter_shape_chunks(shp_path))
+    return ShapeArrays.concatenate(chunks) if chunks else ShapeArrays(0, np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64), np.empty((0, 2)))
+
+
+def _clip_ring(ring: np.ndarray, west: float, south: float, east: float, north: float) -> np.ndarray:
+    """
+    Sutherland-Hodgman clipping of a closed polygon ring to the box, vectorized over each clip edge
+
+    >>> square = np.array([[-0.5, 0.25], [0.5, 0.25], [0.5, 0.75], [-0.5, 0.75], [-0.5, 0.25]])
+    >>> _clip_ring(square, 0, 0, 1, 1).tolist()  # straddling the tile's west edge
+    [[0.0, 0.25], [0.5, 0.25], [0.5, 0.75], [0.0, 0.75], [0.0, 0.25]]
+    >>> _clip_ring(square + [5, 0], 0, 0, 1, 1).tolist()
+    []
+    """
+    if len(ring) > 1 and (ring[0] == ring[-1]).all():
+        ring = ring[:-1]
+    for axis, boundary, keep_greater in ((0, west, True), (0, east, False), (1, south, True), (1, north, False)):
+        if not len(ring):
+            break
+        prev = np.roll(ring, 1, axis=0)
+        cur_in = ring[:, axis] >= boundary if keep_greater else ring[:, axis] <= boundary
+        crossing = cur_in != np.roll(cur_in, 1)
+        delta = ring - prev
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(crossing, (boundary - prev[:, axis]) / delta[:, axis], 0)
+        intersections = prev + t[:, None] * delta
+        # For each vertex in order, we emit the crossing into/out of the box (if any), then the vertex itself (if inside)
+        ring = np.stack([intersections, ring], axis=1)[np.stack([crossing, cur_in], axis=1)]
+    return np.vstack([ring, ring[:1]]) if len(ring) >= 3 else np.empty((0, 2))
+
+
+def _clip_polyline(line: np.ndarray, west: float, south: float, east: float, north: float) -> List[np.ndarray]:
+    """
+    Liang-Barsky clipping of every segment at once, rejoining consecutive visible segments into the pieces inside the box
+
+    >>> out_and_back = np.array([[-0.5, 0.5], [0.5, 0.5], [1.5, 0.5], [1.5, 0.75], [0.5, 0.75]])
+    >>> [piece.tolist() for piece in _clip_polyline(out_and_back, 0, 0, 1, 1)]
+    [[[0.0, 0.5], [0.5, 0.5], [1.0, 0.5]], [[1.0, 0.75], [0.5, 0.75]]]
+    """
+    if len(line) < 2:
+        return [line] if len(line) and west <= line[0, 0] <= east and south <= line[0, 1] <= north else []
+    start, delta = line[:-1], np.diff(line, axis=0)
+    t0, t1 = np.zeros(len(delta)), np.ones(len(delta))
+    visible = np.ones(len(delta), dtype=bool)
+    for p, q in ((-delta[:, 0], start[:, 0] - west), (delta[:, 0], east - start[:, 0]),
+                 (-delta[:, 1], start[:, 1] - south), (delta[:, 1], north - start[:, 1])):
+        visible &= ~((p == 0) & (q < 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = q / p
+        t0 = np.where(p < 0, np.maximum(t0, r), t0)
+        t1 = np.where(p > 0, np.minimum(t1, r), t1)
+    visible &= t0 < t1
+    segments = np.flatnonzero(visible)
+    if not len(segments):
+        return []
+    clipped_starts = start + t0[:, None] * delta
+    clipped_ends = start + t1[:, None] * delta
+    continues_previous = (np.diff(segments) == 1) & (t1[segments[:-1]] == 1) & (t0[segments[1:]] == 0)
+    runs = np.split(segments, np.flatnonzero(~continues_previous) + 1)
+    return [np.vstack([clipped_starts[run[:1]], clipped_ends[run]]) for run in runs]
+
+
+def _clip_parts(base_type: int, parts: List[np.ndarray], west: float, south: float, east: float, north: float) -> List[np.ndarray]:
+    if base_type == POLYGON:
+        clipped = [_clip_ring(part, west, south, east, north) for part in parts]
+        return [ring for ring in clipped if len(ring)]
+    elif base_type == POLYLINE:
+        return [piece for part in parts for piece in _clip_polyline(part, west, south, east, north)]
+    else:  # multipoint: we split the points between tiles, rather than clipping
+        points = np.concatenate(parts)
+        # Half-open, except at the antimeridian & the north pole, which belong to the last tile rather than one off the grid
+        inside_east = points[:, 0] < east if east < 180 else points[:, 0] <= east
+        inside_north = points[:, 1] < north if north < 90 else points[:, 1] <= north
+        inside = (points[:, 0] >= west) & inside_east & (points[:, 1] >= south) & inside_north
+        return [points[inside]] if inside.any() else []
+
+
+def bucket_by_tile(shapes: ShapeArrays, clip: bool=True) -> Dict[LatLon, ShapeArrays]:
+    """
+    Assigns each shape to the 1x1 degree DSF tile(s) its bounding box touches.
+    Shapes that lie within a single tile are grouped in bulk; those spanning tiles are clipped to each tile
+    (or, if clip is False, included whole in each). Points on the antimeridian or the north pole go in the
+    easternmost/northernmost tile.
+
+    >>> edge_points = ShapeArrays.from_shapes(POINT, [(0, [np.array([[180.0, 0.0]])]), (1, [np.array([[-180.0, 90.0]])])])
+    >>> {str(tile): shapes.record_ids.tolist() for tile, shapes in bucket_by_tile(edge_points).items()}
+    {'+00+179': [0], '+89-180': [1]}
+    >>> spanning = ShapeArrays.from_shapes(MULTIPOINT, [(0, [np.array([[179.5, 89.5], [180.0, 90.0], [178.5, 89.5]])])])
+    >>> {str(tile): shapes.points.tolist() for tile, shapes in bucket_by_tile(spanning).items()}
+    {'+89+178': [[178.5, 89.5]], '+89+179': [[179.5, 89.5], [180.0, 90.0]]}
+    """
+    bboxes = shapes.bboxes()
+    west, south = np.floor(bboxes[:, 0]).astype(np.int64), np.floor(bboxes[:, 1]).astype(np.int64)
+    if shapes.base_type in (POINT, MULTIPOINT):  # a point belongs to the one tile whose [west, east) x [south, north) contains it, as in _clip_parts()
+        east, north = np.floor(bboxes[:, 2]).astype(np.int64), np.floor(bboxes[:, 3]).astype(np.int64)
+    else:  # while a line or polygon that ends on a tile's edge doesn't touch the next tile over
+        east = np.maximum(np.ceil(bboxes[:, 2]).astype(np.int64) - 1, west)
+        north = np.maximum(np.ceil(bboxes[:, 3]).astype(np.int64) - 1, south)
+    # Keep everything on the grid (tiles are named for their southwest corner, so the last ones are +179 & +89)
+    west, east = np.clip(west, -180, 179), np.clip(east, -180, 179)
+    south, north = np.clip(south, -90, 89), np.clip(north, -90, 89)
+
+    out: DefaultDict[LatLon, List[ShapeArrays]] = defaultdict(list)
+    single_tile = np.flatnonzero((west == east) & (south == north))
+    tile_keys = (south[single_tile] + 90) * 360 + west[single_tile] + 180
+    order = np.argsort(tile_keys, kind='stable')
+    unique_keys, first_of_key = np.unique(tile_keys[order], return_index=True)
+    for key, shape_indices in zip(unique_keys, np.split(single_tile[order], first_of_key[1:])):
+        out[LatLon(lat=int(key // 360) - 90, lon=int(key % 360) - 180)].append(shapes.take(shape_indices))
+
+    spanning: DefaultDict[LatLon, List[ShapeParts]] = defaultdict(list)
+    for shape_idx in np.flatnonzero((west != east) | (south != north)):
+        parts = shapes.shape_parts(shape_idx)
+        for lat in range(south[shape_idx], north[shape_idx] + 1):
+            for lon in range(west[shape_idx], east[shape_idx] + 1):
+                tile_parts = _clip_parts(shapes.base_type, parts, lon, lat, lon + 1, lat + 1) if clip else parts
+                if tile_parts:
+                    spanning[LatLon(lat, lon)].append((int(shapes.record_ids[shape_idx]), tile_parts))
+    for tile, tile_shapes in spanning.items():
+        out[tile].append(ShapeArrays.from_shapes(shapes.shape_type, tile_shapes))
+
+    return {tile: ShapeArrays.concatenate(arrays) for tile, arrays in out.items()}
+
+
+def iter_tile_buckets(shp_path: Path, clip: bool=True, chunk_bytes: int=64 * 1024 * 1024) -> Iterator[Dict[LatLon, ShapeArrays]]:
+    """bucket_by_tile() for each chunk of a (potentially huge) shapefile in turn. A tile may show up in many chunks."""
+    for chunk in iter_shape_chunks(shp_path, chunk_bytes):
+        yield bucket_by_tile(chunk, clip)